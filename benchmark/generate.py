@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# generates a synthetic Library.musicdb (same header layout, zlib + AES-ECB as the real one) for benchmarks
+from Crypto.Cipher import AES
+from struct import pack, pack_into
+from argparse import ArgumentParser
+import random
+import zlib
+
+AES_KEY = b"BHUILuilfghuila3"
+HEADER_SIZE = 160
+MAX_ENCRYPTED_SIZE = 102400 # real libraries only encrypt the first ~100KiB of the compressed payload
+GENRES = ["Pop", "Rock", "J-Pop", "Anime", "Jazz", "Classical", "Soundtrack", "Electronic"]
+# optional track strings, the first N of them are added to every track with --strings
+EXTRA_STRINGS_TRACK = [
+    (0x8, "comment", "Comment of track {i}"),
+    (0xc, "composer", "Composer {c} 作曲者"),
+    (0x1E, "title_for_sort", "track {i}"),
+    (0x1F, "album_for_sort", "album {a}"),
+    (0x21, "album_artist_for_sort", "artist {r}"),
+    (0x22, "composer_for_sort", "composer {c}"),
+    (0x2e, "copyright", "℗ {y} Label {c}"),
+    (0x12, "description", "Description of track {i}"),
+    (0x3F, "group", "Group {c}"),
+    (0x3B, "purchaser_email", "user{c}@example.com"),
+    (0x3C, "purchaser_name", "User {c}"),
+]
+PLIST = b'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n<plist version="1.0">\n<dict/>\n</plist>\n'
+
+parser = ArgumentParser(description="Generate a synthetic Library.musicdb for benchmarks")
+parser.add_argument("output", help="path to write the Library.musicdb to")
+parser.add_argument("--tracks", type=int, default=10000, help="number of itma (default: 10000)")
+parser.add_argument("--albums", type=int, help="number of iama (default: tracks / 10)")
+parser.add_argument("--artists", type=int, help="number of iAma (default: tracks / 20)")
+parser.add_argument("--strings", type=int, default=4, metavar="N", help=f"optional string bomas per track, 0 to {len(EXTRA_STRINGS_TRACK)} (default: 4)")
+parser.add_argument("--seed", type=int, default=0)
+
+def chunk(fourcc: bytes, body: bytes):
+    return fourcc + pack("<I", len(body) + 8) + body
+
+def boma(subtype: int, payload: bytes):
+    return b"boma" + pack("<III", 20, len(payload) + 16, subtype) + payload
+
+# unk3 is an id of the string in the library, the same string always has the same unk3
+def string_boma(subtype: int, s: str, unk3=0, encoding=1):
+    raw = s.encode("utf-16-le" if encoding == 1 else "utf-8")
+    return boma(subtype, pack("<IIIII", 0, encoding, len(raw), unk3, 0) + raw)
+
+def entity(fourcc: bytes, entity_id: int, header: bytes, bomas: list):
+    return chunk(fourcc, b"\0" * 4 + pack("<Iq", len(bomas), entity_id) + header) + b"".join(bomas)
+
+def album(album_id: int, i: int, title: str, artist: str):
+    bomas = [string_boma(300, title), string_boma(301, artist), string_boma(302, artist)]
+    if i % 7 == 0:
+        bomas.append(string_boma(303, "unhandled album string"))
+    return entity(b"iama", album_id, b"\0" * 20, bomas)
+
+def artist(artist_id: int, i: int, name: str):
+    bomas = [string_boma(400, name), string_boma(401, name.lower())]
+    if i % 5 == 0:
+        bomas.append(boma(402, b"\1\2\3\4unhandled artist binary"))
+    return entity(b"iAma", artist_id, b"\0" * 20, bomas)
+
+def track(track_id: int, i: int, album_id: int, album_i: int, album_title: str, artist_id: int, artist_i: int, artist_name: str, strings: int):
+    genre = i % len(GENRES)
+    bomas = [
+        string_boma(0x2, f"Track {i} タイトル"),
+        string_boma(0x3, album_title, 1 + album_i),
+        string_boma(0x4, artist_name, 1 + artist_i),
+        string_boma(0x5, GENRES[genre], 1 + genre),
+        string_boma(0x6, "MPEG audio file"),
+        string_boma(0x1B, artist_name, 1 + artist_i),
+        string_boma(0x20, artist_name.lower()),
+        string_boma(0x2b, f"JPXX0{i % 10000000:07d}", 0, 2),
+        boma(0x38, b"\0" * 4 + PLIST),
+        boma(0x36, b"\5\0\0\0\0\0\0\0" + bytes(range(40))),
+    ]
+    for subtype, column, template in EXTRA_STRINGS_TRACK[:strings]:
+        bomas.append(string_boma(subtype, template.format(i=i, a=album_i, r=artist_i, c=i % 97, y=1990 + i % 30)))
+    if i % 3 == 0:
+        bomas.append(string_boma(0x40, "unhandled track string"))
+    # fixed-layout part, see ITMA_FIELDS of musicdb.py (the 12 bytes of "????" + boma count + id are added by entity())
+    h = b"\0" * 4
+    h += b"\0" * 8 # ?1 ?2
+    h += b"\0\0" + bytes([i % 2]) + b"\0" # ?3, album_is_compilation
+    h += b"\0" * 4 * 5 # ?4 - ?8
+    h += b"\0\0" + bytes([i % 4]) + b"\0" # ?9, rate_like
+    h += bytes([i % 2, (i % 6) * 20, 0, 0]) # ?10, is_purchased_in_store, rate_star
+    h += b"\0\0\1\x80" # ?11
+    h += b"\0" * 8 # ?12 ?13
+    h += b"\0\0" + bytes([60 + i % 120]) + b"\0" # ?14, bpm
+    h += b"\0" * 8 # ?15 ?16
+    h += bytes([i % 256]) + b"\0\0\0" # ?17
+    h += pack("<I", 1600000000 + i) + b"\0" * 4 + b"\0" * 4 # ?18 ?19 ?20
+    h += pack("<III", 1, 1, 12) # ?21 ?22, track_max
+    h += b"\0" * 32 # ?24 - ?31
+    h += pack("<III", 200000 + i % 100000, 0, i % 12 + 1) # stop_position_msec, ?33, track
+    h += b"\0" * 4 # ?35
+    h += pack("<Iqq", 1990 + i % 30 if i % 10 else 0, album_id, artist_id) # year, album_id, album_artist_or_artist_id
+    h += b"\0" * 16
+    h += pack("<I", i) + b"\0" * 4 + pack("<qq", i, track_id) # ?39 - ?44
+    h += pack("<i", 1000000 + i if i % 2 else 0) # itunes_store_matched_id
+    h += b"\0" * 16 # ?46 - ?49
+    h += pack("<II", 0, 0) # ?50 ?51
+    h += b"\0" * 24 # ?52 - ?57
+    h += pack("<7i", i, album_i, artist_i, genre, i % 97, artist_i, artist_i) # *_sort_order
+    h += pack("<I", 6) + b"\0" * 16 # ?65 - ?69
+    h += pack("<i", 3) + b"\0" * 44 # ?70 - ?81
+    return entity(b"itma", track_id, h, bomas)
+
+def chunks(tracks: int, albums: int, artists: int, strings: int, seed: int):
+    rnd = random.Random(seed)
+    album_ids = [rnd.getrandbits(62) for i in range(albums)]
+    artist_ids = [rnd.getrandbits(62) for i in range(artists)]
+    yield chunk(b"plma", b"\0" * 100)
+    yield chunk(b"lama", pack("<I", albums) + b"\0" * 40)
+    for i, album_id in enumerate(album_ids):
+        yield album(album_id, i, f"Album {i}", f"Artist {i % artists} アーティスト")
+    yield chunk(b"lAma", pack("<I", artists) + b"\0" * 40)
+    for i, artist_id in enumerate(artist_ids):
+        yield artist(artist_id, i, f"Artist {i} アーティスト")
+    yield chunk(b"ltma", pack("<I", tracks) + b"\0" * 40)
+    for i in range(tracks):
+        album_i = i % albums
+        artist_i = album_i % artists
+        yield track(rnd.getrandbits(62), i, album_ids[album_i], album_i, f"Album {album_i}", artist_ids[artist_i], artist_i, f"Artist {artist_i} アーティスト", strings)
+
+# the payload is compressed while writing, so memory doesn't grow with the library.
+# only the head is encrypted, so it's kept until the end and written with the header.
+def generate(path: str, tracks: int, albums=None, artists=None, strings=4, seed=0):
+    albums = albums or max(1, tracks // 10)
+    artists = artists or max(1, tracks // 20)
+    compressor = zlib.compressobj()
+    head = b""
+    with open(path, "wb") as f:
+        f.seek(HEADER_SIZE + MAX_ENCRYPTED_SIZE)
+        def write(data: bytes):
+            nonlocal head
+            if len(head) < MAX_ENCRYPTED_SIZE:
+                n = MAX_ENCRYPTED_SIZE - len(head)
+                head += data[:n]
+                data = data[n:]
+            f.write(data)
+        for c in chunks(tracks, albums, artists, strings, seed):
+            write(compressor.compress(c))
+        write(compressor.flush())
+        file_size = f.tell()
+        encrypted_size = len(head) - len(head) % 16
+        header = bytearray(HEADER_SIZE - 8)
+        pack_into("<I", header, 0, file_size - (MAX_ENCRYPTED_SIZE - len(head)))
+        pack_into("<I", header, 76, encrypted_size)
+        head = AES.new(AES_KEY, AES.MODE_ECB).encrypt(head[:encrypted_size]) + head[encrypted_size:]
+        if len(head) < MAX_ENCRYPTED_SIZE:
+            # small library, the whole payload is in head
+            f.truncate(HEADER_SIZE + len(head))
+        f.seek(0)
+        f.write(b"hfma" + pack("<I", HEADER_SIZE) + header + head)
+
+def main():
+    args = parser.parse_args()
+    generate(args.output, args.tracks, args.albums, args.artists, args.strings, args.seed)
+
+if __name__ == "__main__":
+    main()
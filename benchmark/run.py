@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# runs main.py end-to-end on generated libraries and reports throughput and peak memory per phase
+from argparse import ArgumentParser, REMAINDER
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import os
+import subprocess
+import sys
+
+from generate import generate
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main.py")
+PHASES = ["read", "decrypt", "decompress", "parse", "insert", "export"]
+
+parser = ArgumentParser(description="Benchmark main.py with synthetic Library.musicdb files")
+parser.add_argument("--tracks", type=int, action="append", metavar="N", help="number of tracks, can be given multiple times (default: 10000 and 100000, 1000000 is also worth a run)")
+parser.add_argument("--strings", type=int, default=4, metavar="N", help="optional string bomas per track (default: 4)")
+parser.add_argument("--repeat", type=int, default=1, metavar="N", help="run each size N times and keep the fastest (default: 1)")
+parser.add_argument("--cache-dir", metavar="DIR", help="keep generated libraries here and reuse them")
+parser.add_argument("--output", metavar="PATH", help="write the results to this JSON file")
+parser.add_argument("--baseline", metavar="PATH", help="compare with the results of a previous --output, exit with 1 on regressions")
+parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against --baseline (default: 0.1 = 10%%)")
+parser.add_argument("args", nargs=REMAINDER, help="arguments passed to main.py after --, e.g. -- -j 4 --intern-strings")
+
+def library_path(directory: str, tracks: int, strings: int):
+    path = os.path.join(directory, f"Library.{tracks}.{strings}.musicdb")
+    if not os.path.exists(path):
+        print(f"generating {tracks} tracks...", file=sys.stderr)
+        generate(path + ".tmp", tracks, strings=strings)
+        os.replace(path + ".tmp", path)
+    return path
+
+# main.py writes into the current directory, so every run has its own
+def run(library: str, args: list):
+    with TemporaryDirectory(prefix="musicdb2sqlite.bench.") as cwd:
+        start = perf_counter()
+        subprocess.run([sys.executable, MAIN, os.path.abspath(library), "--stats", "stats.json", *args], cwd=cwd, check=True)
+        seconds = perf_counter() - start
+        with open(os.path.join(cwd, "stats.json")) as f:
+            stats = json.load(f)
+        stats["process_seconds"] = seconds
+        stats["database_size"] = os.path.getsize(os.path.join(cwd, "library.sqlite3"))
+        return stats
+
+def report(results: dict):
+    print(f"{'tracks':>9} {'seconds':>8} {'tracks/s':>9} {'peak RSS':>9}  " + " ".join(f"{phase + ' MB/s':>15}" for phase in PHASES))
+    for tracks, stats in results.items():
+        mbps = [stats["phases"][phase]["bytes_per_sec"] for phase in PHASES]
+        print(
+            f"{tracks:>9} {stats['process_seconds']:>8.2f} {int(tracks) / stats['process_seconds']:>9.0f} {max(stats['peak_rss'], stats['peak_rss_workers']) / 1024 / 1024:>7.0f}MB  "
+            + " ".join(f"{'-' if v is None else f'{v / 1000 / 1000:.1f}':>15}" for v in mbps)
+        )
+        print(" " * 39 + " ".join(f"{stats['phases'][phase]['seconds']:>14.3f}s" for phase in PHASES))
+        print(" " * 39 + "peak RSS after " + ", ".join(f"{stage} {rss / 1024 / 1024:.0f}MB" for stage, rss in stats["peak_rss_stages"].items()))
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for tracks, stats in results.items():
+        if tracks not in baseline:
+            continue
+        before = baseline[tracks]["process_seconds"]
+        after = stats["process_seconds"]
+        print(f"{tracks} tracks: {before:.2f}s -> {after:.2f}s ({(after / before - 1) * 100:+.1f}%)")
+        if after > before * (1 + tolerance):
+            regressions.append(tracks)
+    return regressions
+
+def main():
+    args = parser.parse_args()
+    main_args = args.args[1:] if args.args[:1] == ["--"] else args.args
+    with TemporaryDirectory(prefix="musicdb2sqlite.libraries.") as temp_dir:
+        directory = args.cache_dir or temp_dir
+        os.makedirs(directory, exist_ok=True)
+        results = {}
+        for tracks in args.tracks or [10000, 100000]:
+            library = library_path(directory, tracks, args.strings)
+            runs = [run(library, main_args) for i in range(args.repeat)]
+            results[str(tracks)] = min(runs, key=lambda stats: stats["process_seconds"])
+            results[str(tracks)]["library_size"] = os.path.getsize(library)
+    report(results)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"args": main_args, "strings": args.strings, "results": results}, f, indent=4)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(f"REGRESSION: {', '.join(regressions)} tracks are slower than the baseline by more than {args.tolerance * 100:.0f}%", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,438 +1,1017 @@
 #!/usr/bin/env python3
-from io import BytesIO
-import sys
-from Crypto.Cipher import AES
-from struct import unpack, calcsize
-import zlib
+from struct import unpack_from
 import sqlite3
 import os
 import json
-
-FOURCC = b"hfma"
-UTF16_COLUMNS_ALBUM = {
-    300: "title",
-    301: "artist",
-    302: "album_artist",
-}
-UTF16_COLUMNS_ARTIST = {
-    400: "name",
-    401: "name_for_sort",
+import logging
+import zlib
+import resource
+import sys
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from base64 import b64encode
+from collections import Counter
+from hashlib import blake2b
+from mmap import mmap, ACCESS_READ
+from multiprocessing import Pool
+from shutil import copyfile, copyfileobj
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+import musicdb
+from musicdb import CHUNK_HEADER, ENTITY_PARSERS, READ_BLOCK_SIZE, UTF16_COLUMNS_ALBUM, UTF16_COLUMNS_ARTIST, UTF16_COLUMNS_TRACK, decode_entity, get_content, iter_raw_entities, measure, phase_bytes, phase_times
+
+def positive_int(value: str):
+    n = int(value)
+    if n < 1:
+        raise ArgumentTypeError(f"must be 1 or more: {n}")
+    return n
+
+def non_negative_int(value: str):
+    n = int(value)
+    if n < 0:
+        raise ArgumentTypeError(f"must be 0 or more: {n}")
+    return n
+
+parser = ArgumentParser(description="Convert Apple's Library.musicdb file to SQLite3 Database", fromfile_prefix_chars="@")
+parser.add_argument("libraries", nargs="+", metavar="library", help="path to Library.musicdb. with several paths or directories (searched for *.musicdb), every library is converted into its own directory in --output-dir (batch mode)")
+parser.add_argument("-o", "--output-dir", default=".", metavar="DIR", help="directory to write library.sqlite3 into (default: current directory)")
+parser.add_argument("--validate", choices=["full", "sample", "none"], default="full", help="check unknown fields of every record, every Nth record, or none (default: full)")
+parser.add_argument("--validate-every", type=positive_int, default=100, metavar="N", help="with --validate=sample, check every Nth record (default: 100)")
+parser.add_argument("--anomaly-report", metavar="PATH", help="also write the anomaly histogram to this JSON file")
+parser.add_argument("--unk3-report", metavar="PATH", help="also write the unk3_strings table (the string of each string boma id) to this JSON file")
+parser.add_argument("--incremental", action="store_true", help="update the existing library.sqlite3, only entities whose content changed are decoded again")
+parser.add_argument("--export", choices=["sql", "ndjson", "parquet", "sqlite"], action="append", default=[], help="also export the library (can be given multiple times): sql (dump.sql), ndjson/parquet (one file per table, written while parsing), sqlite (compact copy with VACUUM INTO)")
+parser.add_argument("--export-dir", metavar="DIR", help="directory to write exports into (default: --output-dir)")
+parser.add_argument("--export-no-blobs", action="store_true", help="leave BLOB columns and *_metadata_raw tables out of exports")
+parser.add_argument("--raw", choices=["none", "dedup", "full"], default="full", help="how to store raw chunks (binary columns and *_metadata_raw tables): none, dedup (each distinct boma once, in raw_blobs) or full (default: full)")
+parser.add_argument("--raw-compress", action="store_true", help="with --raw=dedup, zlib-compress raw_blobs which get smaller by it")
+parser.add_argument("--fts", action="store_true", help="build full-text search indexes (FTS5, trigram) tracks_fts, albums_fts and artists_fts over the text columns")
+parser.add_argument("--intern-strings", action="store_true", help="store repeated track strings (artist, album, genre, ...) once in the strings table, tracks becomes a view")
+parser.add_argument("-j", "--jobs", type=non_negative_int, default=1, metavar="N", help="parse with N worker processes (in batch mode, convert N libraries at once), 0 means the number of CPUs (default: 1)")
+parser.add_argument("--merge", metavar="PATH", help="in batch mode, also merge all converted libraries into this database, with a library_id column in every table")
+parser.add_argument("-v", "--verbose", action="count", default=0, help="log progress (-v) or every record and unhandled boma (-vv)")
+parser.add_argument("--stats", metavar="PATH", help="write timings per phase, chunk/boma counts and peak memory to this JSON file")
+
+logger = logging.getLogger("musicdb2sqlite")
+
+# --stats: read/decrypt/decompress are measured by musicdb, insert/export around SQLite and exporters,
+# and parse is what's left of the parsing loop.
+boma_subtype_counts = Counter() # (fourcc of the entity, subtype): count
+row_counts = Counter()
+# peak RSS so far at the end of each stage. read, decrypt, decompress and parse are streamed together
+# (with the batched inserts), so they are one "parse" stage, then "insert" finishes the load and "export" follows
+stage_peak_rss = {}
+
+# --validate and --validate-every, musicdb.validating is set per record from these
+validate_mode = "full"
+validate_every = 100
+# the unk3 check is skipped with --validate=none (unless --unk3-report needs the unk3_strings table)
+track_unk3 = True
+validated_records = 0
+
+TRACK_COLUMNS = [
+    ("id", "INTEGER PRIMARY KEY NOT NULL"),
+    ("unknown_flag", "INTEGER"),
+    ("title", "TEXT"),
+    ("artist", "TEXT"),
+    ("album", "TEXT"),
+    ("album_id", "INTEGER"),
+    ("album_is_compilation", "INTEGER"),
+    ("album_artist", "TEXT"),
+    ("album_artist_or_artist_id", "INTEGER"),
+    ("track", "INTEGER"),
+    ("track_max", "INTEGER"),
+    ("composer", "TEXT"),
+    ("genre", "TEXT"),
+    ("bpm", "INTEGER"),
+    ("year", "INTEGER"),
+    ("rate_like", "INTEGER"),
+    ("rate_star", "INTEGER"),
+    ("stop_position_msec", "INTEGER"),
+    ("comment", "TEXT"),
+    ("description", "TEXT"),
+    ("group", "TEXT"),
+    ("localized_file_type", "TEXT"),
+    ("copyright", "TEXT"),
+    ("isrc", "TEXT"),
+    ("title_for_sort", "TEXT"),
+    ("album_for_sort", "TEXT"),
+    ("artist_for_sort", "TEXT"),
+    ("album_artist_for_sort", "TEXT"),
+    ("composer_for_sort", "TEXT"),
+    ("title_sort_order", "INTEGER"),
+    ("album_sort_order", "INTEGER"),
+    ("artist_sort_order", "INTEGER"),
+    ("genre_sort_order", "INTEGER"),
+    ("composer_sort_order", "INTEGER"),
+    ("album_artist_sort_order", "INTEGER"),
+    ("album_artist_or_artist_sort_order", "INTEGER"),
+    ("itunes_store_flavor", "TEXT"),
+    ("itunes_store_movi", "TEXT"),
+    ("itunes_store_matched_id", "INTEGER"),
+    ("is_purchased_in_store", "INTEGER"),
+    ("purchaser_email", "TEXT"),
+    ("purchaser_name", "TEXT"),
+    ("url", "TEXT"),
+    ("binary", "BLOB NOT NULL"),
+    ("hash", "BLOB NOT NULL"),
+]
+
+# with --intern-strings, these columns are stored as ids of the strings table (each distinct string is stored once),
+# the table is stored as tracks_normalized and the tracks view resolves them back to the same columns as usual
+INTERNED_COLUMNS_TRACK = [
+    "album",
+    "artist",
+    "genre",
+    "album_artist",
+    "composer",
+    "localized_file_type",
+    "album_for_sort",
+    "artist_for_sort",
+    "album_artist_for_sort",
+    "composer_for_sort",
+    "copyright",
+    "itunes_store_flavor",
+    "purchaser_email",
+    "purchaser_name",
+    "group",
+]
+INTERNED_SUBTYPES_TRACK = {subtype for subtype, column in UTF16_COLUMNS_TRACK.items() if column in INTERNED_COLUMNS_TRACK}
+storage_tables = {}
+
+def storage_table(table: str):
+    return storage_tables.get(table, table)
+
+# the database is loaded into a temporary file with journaling, syncs and foreign keys off,
+# then indexed, checked once and renamed into place, so readers never see a half-written database
+def connect_for_bulk_load(path: str):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=OFF")
+    db.execute("PRAGMA synchronous=OFF")
+    db.execute("PRAGMA foreign_keys=false")
+    db.execute("PRAGMA cache_size=-65536") # 64MiB
+    return db
+
+# with --fts: {table: text columns} indexed by {table}_fts. the FTS5 tables are external content tables
+# (texts are not stored twice), rows are added and removed by insert_pending_rows() along with the tables.
+FTS_COLUMNS = {
+    "albums": list(UTF16_COLUMNS_ALBUM.values()),
+    "artists": list(UTF16_COLUMNS_ARTIST.values()),
+    "tracks": list(UTF16_COLUMNS_TRACK.values()),
 }
-UTF16_COLUMNS_TRACK = {
-    0x2: "title",
-    0x3: "album",
-    0x4: "artist",
-    0x5: "genre",
-    0x6: "localized_file_type",
-    0x8: "comment",
-    0xb: "url",
-    0xc: "composer",
-    0x12: "description",
-    0x1B: "album_artist",
-    0x1D: "itunes_store_movi",
-    0x1E: "title_for_sort",
-    0x1F: "album_for_sort",
-    0x20: "artist_for_sort",
-    0x21: "album_artist_for_sort",
-    0x22: "composer_for_sort",
-    0x2b: "isrc",
-    0x2e: "copyright",
-    0x34: "itunes_store_flavor",
-    0x3B: "purchaser_email",
-    0x3C: "purchaser_name",
-    0x3F: "`group`",
+fts = False
+
+def fts_table_sql(table: str, content_rowid="id"):
+    column_names = ", ".join(f'"{c}"' for c in FTS_COLUMNS[table])
+    return f"CREATE VIRTUAL TABLE {table}_fts USING fts5({column_names}, content='{table}', content_rowid='{content_rowid}', tokenize='trigram')"
+
+def create_fts_tables(db: sqlite3.Connection):
+    for table in FTS_COLUMNS:
+        try:
+            db.execute(fts_table_sql(table))
+        except sqlite3.OperationalError as e:
+            raise Exception(f"--fts needs SQLite 3.34 or later with FTS5 (SQLite {sqlite3.sqlite_version}: {e})")
+
+def create_database(path: str, intern_strings: bool, raw: str):
+    if os.path.exists(path):
+        os.remove(path)
+    db = connect_for_bulk_load(path)
+    raw_binary = "INTEGER NOT NULL REFERENCES raw_blobs(id)" if raw == "dedup" else "BLOB NOT NULL"
+    if raw == "dedup":
+        db.execute("CREATE TABLE raw_blobs (id INTEGER PRIMARY KEY NOT NULL, hash BLOB NOT NULL UNIQUE, compressed INTEGER NOT NULL, binary BLOB NOT NULL)")
+    tracks_table = storage_table("tracks")
+    track_columns = ",\n        ".join(
+        f'"{name}" INTEGER REFERENCES strings(id)' if intern_strings and name in INTERNED_COLUMNS_TRACK else f'"{name}" {type}'
+        for name, type in TRACK_COLUMNS
+    )
+    if intern_strings:
+        db.execute("CREATE TABLE strings (id INTEGER PRIMARY KEY NOT NULL, value TEXT NOT NULL UNIQUE)")
+    db.execute("""CREATE TABLE albums(
+        id INTEGER PRIMARY KEY NOT NULL,
+        title TEXT,
+        artist TEXT,
+        album_artist TEXT,
+        binary BLOB NOT NULL,
+        hash BLOB NOT NULL
+    )""")
+    db.execute(f"CREATE TABLE {storage_table('albums_metadata_raw')} (album_id INTEGER NOT NULL, type INTEGER NOT NULL, binary {raw_binary}, FOREIGN KEY (album_id) REFERENCES albums(id))")
+    db.execute("""CREATE TABLE artists (
+        id INTEGER PRIMARY KEY NOT NULL,
+        name TEXT,
+        name_for_sort TEXT,
+        binary BLOB NOT NULL,
+        hash BLOB NOT NULL
+    )""")
+    db.execute(f"CREATE TABLE {storage_table('artists_metadata_raw')} (artist_id INTEGER NOT NULL, type INTEGER NOT NULL, binary {raw_binary}, FOREIGN KEY (artist_id) REFERENCES artists(id))")
+    db.execute(f"""CREATE TABLE {tracks_table} (
+        {track_columns},
+        FOREIGN KEY (album_artist_or_artist_id) REFERENCES artists(id),
+        FOREIGN KEY (album_id) REFERENCES albums(id)
+    )""")
+    if intern_strings:
+        track_view_columns = ",\n        ".join(
+            f'(SELECT value FROM strings WHERE id = t."{name}") AS "{name}"' if name in INTERNED_COLUMNS_TRACK else f't."{name}" AS "{name}"'
+            for name, type in TRACK_COLUMNS
+        )
+        db.execute(f"""CREATE VIEW tracks AS SELECT
+        {track_view_columns}
+    FROM {tracks_table} AS t""")
+    db.execute(f"CREATE TABLE {storage_table('tracks_metadata_raw')} (track_id INTEGER NOT NULL, type INTEGER NOT NULL, binary {raw_binary}, FOREIGN KEY (track_id) REFERENCES {tracks_table}(id))")
+    if raw == "dedup":
+        for table, raw_table, id_column in ENTITY_TABLES.values():
+            db.execute(f"""CREATE VIEW {raw_table} AS SELECT
+        r.{id_column} AS {id_column},
+        r.type AS type,
+        b.binary AS binary,
+        b.compressed AS compressed
+    FROM {storage_table(raw_table)} AS r JOIN raw_blobs AS b ON b.id = r.binary""")
+    create_unk3_table(db)
+    if fts:
+        create_fts_tables(db)
+    return db
+
+# the first string seen for each unk3 of string bomas, later ones are checked against it in insert_unk3_strings
+def create_unk3_table(db: sqlite3.Connection):
+    db.execute("CREATE TABLE IF NOT EXISTS unk3_strings (subtype INTEGER NOT NULL, unk3 INTEGER NOT NULL, string TEXT NOT NULL, PRIMARY KEY (subtype, unk3)) WITHOUT ROWID")
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS unk3_batch (subtype INTEGER NOT NULL, unk3 INTEGER NOT NULL, string TEXT NOT NULL, validating INTEGER NOT NULL)")
+
+# rows are assembled in memory (one tuple per entity) and bulk-inserted with executemany.
+# parents come first so foreign keys are satisfied when a batch is flushed.
+INSERT_BATCH_SIZE = 1000
+pending_rows = {table: [] for table in ["albums", "artists", "tracks", "albums_metadata_raw", "artists_metadata_raw", "tracks_metadata_raw"]}
+table_columns = {}
+
+# fourcc: (table, raw table, column of the raw table referencing the table)
+ENTITY_TABLES = {
+    b"iama": ("albums", "albums_metadata_raw", "album_id"),
+    b"iAma": ("artists", "artists_metadata_raw", "artist_id"),
+    b"itma": ("tracks", "tracks_metadata_raw", "track_id"),
 }
 
-UNKNOWN_CONST_BOMA_TRACK = {
-    # 0x38: coming from some old webview's purchase/redownload button?
-    # 0x38: b'8\x00\x00\x00\x00\x00\x00\x00<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n<plist version="1.0">\n<dict/>\n</plist>\n',
-}
+# incremental mode: {table: {id: hash}} of the existing database, None when rebuilding from scratch.
+# entities whose hash (of the entity chunk and its boma chunks) didn't change are not decoded at all.
+known_hashes = None
+seen_ids = {table: [] for table, _, _ in ENTITY_TABLES.values()}
+unchanged_counts = Counter()
+
+# exporters which get every row when it's flushed, before it's written into SQLite
+row_exporters = []
+# with --intern-strings: {string: id} of the strings table
+string_ids = None
+next_string_id = None
+# --raw: with none, raw chunks are not stored at all (and binary columns are empty).
+# with dedup, *_metadata_raw rows are stored with ids of raw_blobs, which has each distinct boma chunk once
+# (keyed by its hash: {hash: id} in blob_ids), and *_metadata_raw views resolve them back.
+raw_mode = "full"
+raw_compress = False
+blob_ids = None
+next_blob_id = None
+
+def intern_track_strings(rows: list):
+    global next_string_id
+    indexes = [table_columns["tracks"].index(column) for column in INTERNED_COLUMNS_TRACK]
+    new_strings = []
+    for n, row in enumerate(rows):
+        row = list(row)
+        for i in indexes:
+            value = row[i]
+            if value is None:
+                continue
+            string_id = string_ids.get(value)
+            if string_id is None:
+                string_id = string_ids[value] = next_string_id
+                next_string_id += 1
+                new_strings.append((string_id, value))
+            row[i] = string_id
+        rows[n] = tuple(row)
+    return new_strings
+
+def dedup_raw_blobs(rows: list):
+    global next_blob_id
+    new_blobs = []
+    for n, (entity_id, subtype, binary) in enumerate(rows):
+        blob_hash = blake2b(binary, digest_size=16).digest()
+        blob_id = blob_ids.get(blob_hash)
+        if blob_id is None:
+            blob_id = blob_ids[blob_hash] = next_blob_id
+            next_blob_id += 1
+            compressed = zlib.compress(binary) if raw_compress else binary
+            if len(compressed) < len(binary):
+                new_blobs.append((blob_id, blob_hash, 1, compressed))
+            else:
+                new_blobs.append((blob_id, blob_hash, 0, binary))
+        rows[n] = (entity_id, subtype, blob_id)
+    return new_blobs
+
+def insert_entity(table: str, entity: musicdb.Entity, binary: bytes, entity_hash: bytes):
+    pending_rows[table].append(tuple(
+        binary if column == "binary" else entity_hash if column == "hash" else getattr(entity, column, None) for column in table_columns[table]
+    ))
 
-def should_same(actual, expected, message: str, skip=False):
-    if actual != expected and not skip:
-        raise Exception(f"{message} (expected: {expected}, actual: {actual})")
-def should_one_of_them(actual, expected_patterns: list, message: str, skip=False):
-    if skip:
+def flush_rows(db: sqlite3.Connection, force=False):
+    if not force and all(len(rows) < INSERT_BATCH_SIZE for rows in pending_rows.values()):
         return
-    for expected in expected_patterns:
-        if actual == expected:
-            return
-    raise Exception(f"{message} (expected: {expected_patterns}, actual: {actual})")
-
-def unpack_reader(format: str, reader: BytesIO):
-    return unpack(format, reader.read(calcsize(format)))
-
-def get_content():
-    with open(sys.argv[1], "rb") as lf:
-        first_fourcc = lf.read(4)
-        should_same(first_fourcc, FOURCC, "FourCC is wrong")
-        header_size, = unpack("<I", lf.read(4))
-        header_size -= 8 # fourcc + int32 = 8 bytes
-        header = lf.read(header_size)
-
-        file_size, = unpack("<I", header[0:4])
-        print(file_size)
-        encrypted_size, = unpack("<I", header[76:80])
-        print(encrypted_size)
-
-        data_size = file_size - (header_size + 8)
-        encrypted_size = data_size - (data_size % 16) if encrypted_size > file_size else encrypted_size
-
-        encrypted = b""
-        lf.seek(header_size + 8)
-        raw = lf.read()
-        if encrypted_size > 0:
-            encrypted = lf.read(encrypted_size)
-            encrypted = AES.new(b"BHUILuilfghuila3", AES.MODE_ECB).decrypt(raw[:encrypted_size])
-        raw = BytesIO(zlib.decompress(encrypted + raw[encrypted_size:]))
-        return raw
-
-if os.path.exists("library.sqlite3"):
-    os.remove("library.sqlite3")
-db = sqlite3.connect("library.sqlite3")
-db.execute("PRAGMA foreign_keys=true")
-db.execute("""CREATE TABLE albums(
-    id INTEGER PRIMARY KEY NOT NULL,
-    title TEXT,
-    artist TEXT,
-    album_artist TEXT,
-    binary BLOB NOT NULL
-)""")
-db.execute("CREATE TABLE albums_metadata_raw (album_id INTEGER NOT NULL, type INTEGER NOT NULL, binary BLOB NOT NULL, FOREIGN KEY (album_id) REFERENCES albums(id))")
-db.execute("""CREATE TABLE artists (
-    id INTEGER PRIMARY KEY NOT NULL,
-    name TEXT,
-    name_for_sort TEXT,
-    binary BLOB NOT NULL
-)""")
-db.execute("CREATE TABLE artists_metadata_raw (artist_id INTEGER NOT NULL, type INTEGER NOT NULL, binary BLOB NOT NULL, FOREIGN KEY (artist_id) REFERENCES artists(id))")
-db.execute("""CREATE TABLE tracks (
-    id INTEGER PRIMARY KEY NOT NULL,
-    unknown_flag INTEGER,
-    title TEXT,
-    artist TEXT,
-    album TEXT,
-    album_id INTEGER,
-    album_is_compilation INTEGER,
-    album_artist TEXT,
-    album_artist_or_artist_id INTEGER,
-    track INTEGER,
-    track_max INTEGER,
-    composer TEXT,
-    genre TEXT,
-    bpm INTEGER,
-    year INTEGER,
-    rate_like INTEGER,
-    rate_star INTEGER,
-    stop_position_msec INTEGER,
-    comment TEXT,
-    description TEXT,
-    `group` TEXT,
-    localized_file_type TEXT,
-    copyright TEXT,
-    isrc TEXT,
-    title_for_sort TEXT,
-    album_for_sort TEXT,
-    artist_for_sort TEXT,
-    album_artist_for_sort TEXT,
-    composer_for_sort TEXT,
-    title_sort_order INTEGER,
-    album_sort_order INTEGER,
-    artist_sort_order INTEGER,
-    genre_sort_order INTEGER,
-    composer_sort_order INTEGER,
-    album_artist_sort_order INTEGER,
-    album_artist_or_artist_sort_order INTEGER,
-    itunes_store_flavor TEXT,
-    itunes_store_movi TEXT,
-    itunes_store_matched_id INTEGER,
-    is_purchased_in_store INTEGER,
-    purchaser_email TEXT,
-    purchaser_name TEXT,
-    url TEXT,
-    binary BLOB NOT NULL,
-    FOREIGN KEY (album_artist_or_artist_id) REFERENCES artists(id),
-    FOREIGN KEY (album_id) REFERENCES albums(id)
-)""")
-db.execute("CREATE TABLE tracks_metadata_raw (track_id INTEGER NOT NULL, type INTEGER NOT NULL, binary BLOB NOT NULL, FOREIGN KEY (track_id) REFERENCES tracks(id))")
-
-content = get_content()
-
-def read_chunk():
-    prefix = 8
-    fourcc = content.read(4)
-    if fourcc == b"":
+    if len(row_exporters) > 0:
+        with measure("export"):
+            for table, rows in pending_rows.items():
+                for exporter in row_exporters:
+                    exporter.write(table, rows)
+    with measure("insert"):
+        insert_pending_rows(db)
+
+def insert_pending_rows(db: sqlite3.Connection):
+    if fts:
+        # taken before strings are interned
+        fts_rows = {}
+        for table, fts_columns in FTS_COLUMNS.items():
+            indexes = [table_columns[table].index(column) for column in ["id", *fts_columns]]
+            fts_rows[table] = [tuple(row[i] for i in indexes) for row in pending_rows[table]]
+    if string_ids is not None:
+        db.executemany("INSERT INTO strings (id, value) VALUES (?,?)", intern_track_strings(pending_rows["tracks"]))
+    if blob_ids is not None:
+        for table, raw_table, id_column in ENTITY_TABLES.values():
+            db.executemany("INSERT INTO raw_blobs (id, hash, compressed, binary) VALUES (?,?,?,?)", dedup_raw_blobs(pending_rows[raw_table]))
+    if known_hashes is not None:
+        # raw rows (and search index entries) of updated entities are replaced, not merged
+        for table, raw_table, id_column in ENTITY_TABLES.values():
+            updated_ids = [(row[0],) for row in pending_rows[table] if row[0] in known_hashes[table]]
+            db.executemany(f"DELETE FROM {storage_table(raw_table)} WHERE {id_column}=?", updated_ids)
+            if fts:
+                delete_fts_rows(db, table, updated_ids)
+    for table, rows in pending_rows.items():
+        if len(rows) == 0:
+            continue
+        columns = table_columns[table]
+        column_names = ", ".join(f'"{c}"' for c in columns)
+        sql = f"INSERT INTO {storage_table(table)}({column_names}) VALUES ({', '.join('?' * len(columns))})"
+        if known_hashes is not None and table in known_hashes:
+            sql += " ON CONFLICT(id) DO UPDATE SET " + ", ".join(f'"{c}"=excluded."{c}"' for c in columns[1:])
+        db.executemany(sql, rows)
+        row_counts[table] += len(rows)
+        rows.clear()
+    if fts:
+        for table, columns in FTS_COLUMNS.items():
+            column_names = ", ".join(f'"{c}"' for c in columns)
+            db.executemany(f"INSERT INTO {table}_fts(rowid, {column_names}) VALUES (?, {', '.join('?' * len(columns))})", fts_rows[table])
+    insert_unk3_strings(db)
+
+# new (subtype, unk3) keep their first string (rowids of unk3_batch are in parsing order),
+# then every string of the batch is compared with the kept one
+def insert_unk3_strings(db: sqlite3.Connection):
+    if musicdb.unk3_strings is None:
+        return
+    db.executemany("INSERT INTO temp.unk3_batch (subtype, unk3, string, validating) VALUES (?,?,?,?)", musicdb.unk3_strings)
+    musicdb.unk3_strings.clear()
+    db.execute("INSERT OR IGNORE INTO unk3_strings (subtype, unk3, string) SELECT subtype, unk3, string FROM temp.unk3_batch ORDER BY rowid")
+    for subtype, unk3, expected, actual in db.execute(
+        "SELECT b.subtype, b.unk3, s.string, b.string FROM temp.unk3_batch AS b JOIN unk3_strings AS s USING (subtype, unk3) WHERE b.validating AND b.string != s.string ORDER BY b.rowid"
+    ):
+        logger.debug("UNK3 Invalid %d %d %s %s", subtype, unk3, actual, expected)
+        musicdb.report_anomaly("unk3", expected, actual)
+    db.execute("DELETE FROM temp.unk3_batch")
+
+# external content FTS5 tables need the old values for removing a row, so this has to be called before the row is changed
+def delete_fts_rows(db: sqlite3.Connection, table: str, ids: list):
+    column_names = ", ".join(f'"{c}"' for c in FTS_COLUMNS[table])
+    db.executemany(f"INSERT INTO {table}_fts({table}_fts, rowid, {column_names}) SELECT 'delete', id, {column_names} FROM {table} WHERE id=?", ids)
+
+# parses entities from content (until `end` if given) into pending_rows, returns the index of the next record
+def parse_chunks(content, record_index=0, end=None, on_entity=None):
+    global validated_records
+    for fourcc, entity_id, bc, bomas in iter_raw_entities(content, end):
+        table, raw_table, id_column = ENTITY_TABLES[fourcc]
+        entity_hash = blake2b(bc, digest_size=16)
+        for subtype, cbc, cc in bomas:
+            entity_hash.update(cbc)
+            boma_subtype_counts[fourcc, subtype] += 1
+        entity_hash = entity_hash.digest()
+        record_index += 1
+        if known_hashes is not None:
+            seen_ids[table].append(entity_id)
+            if known_hashes[table].get(entity_id) == entity_hash:
+                unchanged_counts[table] += 1
+                continue
+        if validate_mode == "sample":
+            musicdb.validating = (record_index - 1) % validate_every == 0
+        validated_records += musicdb.validating
+        if raw_mode != "none":
+            # raw tables are always (id, type, binary)
+            pending_rows[raw_table].extend((entity_id, subtype, cbc) for subtype, cbc, cc in bomas)
+        insert_entity(table, decode_entity(fourcc, entity_id, bc, bomas), bc if raw_mode != "none" else b"", entity_hash)
+        if on_entity is not None:
+            on_entity()
+    return record_index
+
+# parallel parsing: the decompressed library is spilled to a temporary file which every worker mmaps,
+# a first pass splits it into ranges of whole entities (an entity chunk and its boma chunks),
+# then workers decode the ranges and the main process is the only one writing into SQLite.
+ENTITIES_PER_RANGE = 2000
+
+def index_ranges(buf, size: int):
+    ranges = []
+    start = 0
+    range_record_index = 0
+    record_index = 0
+    offset = 0
+    while offset < size:
+        fourcc, chunk_len = CHUNK_HEADER.unpack_from(buf, offset)
+        if fourcc == b"boma":
+            chunk_len, = unpack_from("<I", buf, offset + 8)
+        elif record_index - range_record_index >= ENTITIES_PER_RANGE:
+            # a non-boma chunk never belongs to the previous entity
+            ranges.append((start, offset, range_record_index))
+            start = offset
+            range_record_index = record_index
+        if fourcc in ENTITY_PARSERS:
+            record_index += 1
+        # a broken length would never move offset forward
+        if chunk_len < CHUNK_HEADER.size + (4 if fourcc == b"boma" else 0):
+            raise Exception(f"chunk length is too short at offset {offset} (fourcc: {fourcc}, length: {chunk_len})")
+        offset += chunk_len
+    ranges.append((start, size, range_record_index))
+    return ranges, record_index
+
+worker_content = None
+
+def init_worker(path: str, columns: dict, mode: str, every: int, unk3: bool, hashes, string_subtypes: set, raw: str, log_level: int):
+    global worker_content, validate_mode, validate_every, track_unk3, known_hashes, raw_mode
+    logging.basicConfig(level=log_level, format="%(message)s")
+    musicdb.decoded_strings_subtypes.update(string_subtypes)
+    with open(path, "rb") as f:
+        worker_content = mmap(f.fileno(), 0, access=ACCESS_READ)
+    table_columns.update(columns)
+    validate_mode = mode
+    validate_every = every
+    track_unk3 = unk3
+    known_hashes = hashes
+    raw_mode = raw
+
+def parse_range(task):
+    global validated_records, unchanged_counts, boma_subtype_counts
+    start, end, record_index = task
+    musicdb.anomaly_counts = Counter()
+    musicdb.anomaly_examples = {}
+    musicdb.unk3_strings = [] if track_unk3 else None
+    musicdb.chunk_counts = Counter()
+    musicdb.validating = validate_mode != "none"
+    validated_records = 0
+    unchanged_counts = Counter()
+    boma_subtype_counts = Counter()
+    worker_content.seek(start)
+    parse_chunks(worker_content, record_index, end)
+    rows = {table: list(rows) for table, rows in pending_rows.items()}
+    ids = {table: list(ids) for table, ids in seen_ids.items()}
+    for table_rows in [*pending_rows.values(), *seen_ids.values()]:
+        table_rows.clear()
+    return rows, ids, unchanged_counts, musicdb.anomaly_counts, musicdb.anomaly_examples, musicdb.unk3_strings, validated_records, musicdb.chunk_counts, boma_subtype_counts
+
+def parse_parallel(content, jobs: int, db: sqlite3.Connection, temp_dir: str):
+    global validated_records
+    with NamedTemporaryFile(prefix="library.", suffix=".decompressed", dir=temp_dir) as f:
+        copyfileobj(content, f, READ_BLOCK_SIZE)
+        f.flush()
+        size = f.tell()
+        if size == 0:
+            return 0
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as buf:
+            ranges, records = index_ranges(buf, size)
+        with Pool(jobs, init_worker, (f.name, table_columns, validate_mode, validate_every, track_unk3, known_hashes, musicdb.decoded_strings_subtypes, raw_mode, logger.getEffectiveLevel())) as pool:
+            for rows, ids, unchanged, counts, examples, unk3_strings, range_validated_records, chunks, bomas in pool.imap(parse_range, ranges):
+                for table, table_rows in rows.items():
+                    pending_rows[table].extend(table_rows)
+                # ranges come in order, so unk3 strings are checked in the same order as without -j
+                if track_unk3:
+                    musicdb.unk3_strings.extend(unk3_strings)
+                flush_rows(db)
+                for table, table_ids in ids.items():
+                    seen_ids[table].extend(table_ids)
+                unchanged_counts.update(unchanged)
+                for label, count in counts.items():
+                    musicdb.anomaly_counts[label] += count
+                    musicdb.anomaly_examples.setdefault(label, examples[label])
+                validated_records += range_validated_records
+                musicdb.chunk_counts.update(chunks)
+                boma_subtype_counts.update(bomas)
+    return records
+
+# returns the existing database and its entity hashes, or None if it has to be rebuilt
+def open_existing_database(path: str):
+    if not os.path.exists(path):
         return None
-    chunk_len, = unpack("<I", content.read(4))
-    if fourcc == b"boma":
-        prefix += 4
-        should_same(chunk_len, 20, "boma chunk first four bytes are wrong")
-        chunk_len, = unpack("<I", content.read(4))
-    c = content.read(chunk_len - prefix)
-    # print(fourcc, chunk_len, c)
-    return fourcc, c
-
-unk3_dic = {}
-
-def read_utf16_boma(b: BytesIO, subtype: int):
-    unk1, encoding, slen, unk3, unk4 = unpack_reader("<IIIII", b)
-    should_same(unk1, 0, "unk1")
-    should_one_of_them(encoding, [1, 2], "unk2")
-    s = cc.read(slen).decode("utf-16" if encoding == 1 else "utf-8") # maybe ASCII?
-    if unk3 != 0:
-        if subtype not in unk3_dic:
-            unk3_dic[subtype] = {}
-        if unk3 in unk3_dic[subtype]:
-            if s != unk3_dic[subtype][unk3]:
-                print("UNK3 Invalid", subtype, unk3, s, unk3_dic[subtype][unk3])
-        else:
-            unk3_dic[subtype][unk3] = s
-    should_same(unk4, 0, "unk4")
-    return s
-
-boma_counts = 0
-while content.readable():
-    r = read_chunk()
-    if r is None:
-        break
-    fourcc, bc = r
-    c = BytesIO(bc)
-    if fourcc == b"iama":
-        c.read(4)
-        boma_counts, album_id = unpack("<Iq", c.read(4 + 8))
-        db.execute("INSERT INTO albums(id, binary) VALUES (?,?)", [album_id, bc])
-        for i in range(boma_counts):
-            fcc, cbc = read_chunk()
-            cc = BytesIO(cbc)
-            subtype, = unpack_reader("<I", cc)
-            should_same(fcc, b"boma", "not boma")
-            db.execute("INSERT INTO albums_metadata_raw (album_id, type, binary) VALUES (?,?,?)", [album_id, subtype, cbc])
-            column_name = UTF16_COLUMNS_ALBUM.get(subtype)
-            if column_name is not None:
-                value = read_utf16_boma(cc, subtype)
-                if column_name == "title":
-                    print("ALBUM:TITLE", value)
-                db.execute(f"UPDATE albums SET {column_name}=? WHERE id=?", [value, album_id])
-            else:
-                # try:
-                print("WARN:ALBUM:UNHANDLED_BOMA", subtype, hex(subtype), read_utf16_boma(cc, subtype))
-                # except:
-                    # print("cant", subtype, hex(subtype), cbc)
-    elif fourcc == b"iAma":
-        c.read(4)
-        boma_counts, artist_id = unpack("<Iq", c.read(4 + 8))
-        db.execute("INSERT INTO artists(id, binary) VALUES (?,?)", [artist_id, bc])
-        for i in range(boma_counts):
-            fcc, cbc = read_chunk()
-            cc = BytesIO(cbc)
-            subtype, = unpack_reader("<I", cc)
-            should_same(fcc, b"boma", "not boma")
-            db.execute("INSERT INTO artists_metadata_raw (artist_id, type, binary) VALUES (?,?,?)", [artist_id, subtype, cbc])
-            column_name = UTF16_COLUMNS_ARTIST.get(subtype)
-            if column_name is not None:
-                value = read_utf16_boma(cc, subtype)
-                if column_name == "title":
-                    print("ALBUM:TITLE", value)
-                db.execute(f"UPDATE artists SET {column_name}=? WHERE id=?", [value, artist_id])
-            else:
-                try:
-                    print("WARN:ARTIST:UNHANDLED_BOMA", subtype, hex(subtype), read_utf16_boma(cc, subtype))
-                except:
-                    print("WARN:ARTIST:UNHANDLED_BOMA_BINARY", subtype, hex(subtype), cbc)
-    elif fourcc == b"itma":
-        c.read(4) # ?
-        boma_counts, track_id = unpack("<Iq", c.read(4 + 8))
-        c.read(4) # ?
-        db.execute("INSERT INTO tracks(id, binary) VALUES (?,?)", [track_id, bc])
-        for i in range(boma_counts):
-            fcc, cbc = read_chunk()
-            cc = BytesIO(cbc)
-            subtype, = unpack_reader("<I", cc)
-            should_same(fcc, b"boma", "not boma")
-            db.execute("INSERT INTO tracks_metadata_raw (track_id, type, binary) VALUES (?,?,?)", [track_id, subtype, cbc])
-            if subtype in UTF16_COLUMNS_TRACK:
-                column_name = UTF16_COLUMNS_TRACK[subtype]
-                value = read_utf16_boma(cc, subtype)
-                if column_name == "title":
-                    print("TRACK:TITLE", value)
-                db.execute(f"UPDATE tracks SET {column_name}=? WHERE id=?", [value, track_id])
-            elif subtype in UNKNOWN_CONST_BOMA_TRACK:
-                should_same(cbc, UNKNOWN_CONST_BOMA_TRACK[subtype], f"boma chunk that considered as const, but it looks not!? please report! (subtype={subtype})")
-            else:
-                seek_point = cc.tell()
-                try:
-                    print("WARN:TRACK:UNHANDLED_BOMA:STRING", subtype, hex(subtype), read_utf16_boma(cc, subtype))
-                except:
-                    cc.seek(seek_point)
-                    # print("WARN:TRACK:UNHANDLED_BOMA:BINARY", subtype, hex(subtype), cc.read().hex(" ", 4).replace("0", "_"))
-        should_one_of_them(c.read(4), [b"\0\0\0\0", b"\0\0\0\1", b"\0\1\0\1", b"\0\1\0\0", b"\0\0\1\1", b"\0\0\1\0"], "? 1")
-        should_one_of_them(c.read(4), [b"\0\0\0\0", b"\1\0\0\0", b"\0\1\0\0"], "? 2")
-
-        should_same(c.read(2), b"\0\0", "?3.1")
-        album_is_compilation, = unpack_reader("<B", c)
-        should_one_of_them(album_is_compilation, [0, 1], "album_is_complation flag is wrong")
-        db.execute(f"UPDATE tracks SET album_is_compilation=? WHERE id=?", [album_is_compilation, track_id])
-        should_one_of_them(c.read(1), [b"\0", b"\1"], "?3.2")
-
-        should_one_of_them(c.read(4), [b"\0\0\0\0", b"\0\0\1\0"], "? 4")
-
-        should_same(c.read(3), b"\0\0\0", "? 5.1")
-        should_one_of_them(c.read(1)[0], [0, 1], "? 5.2 unknown flag, zero in 99% cases, but only some rare cases, this will be 1")
-
-        should_same(c.read(1), b"\0", "?6.1")
-        should_one_of_them(c.read(1)[0], [0, 1], "? 6.2 unknown flag, zero in 99% cases, but only some rare cases, this will be 1")
-        should_one_of_them(c.read(2), [b"\0\0", b"\1\0", b"\0\1"], "?6.3")
-
-        should_one_of_them(c.read(1), [b"\0", b"\1"], "?7.1")
-        should_one_of_them(c.read(1)[0], [0, 1], "? 7.2 unknown flag, sometimes 1.")
-        should_one_of_them(c.read(1)[0], [0, 1], "? 7.3 unknown flag, sometimes 1.")
-        should_one_of_them(c.read(1)[0], [0, 1], "? 7.4 unknown flag, sometimes 1.")
-
-        should_same(c.read(1), b"\0", "?8.1")
-        should_one_of_them(c.read(1)[0], [0, 1, 3], "? 8.2 unknown flag, sometimes 1.")
-        should_one_of_them(c.read(2), [b"\0\0", b"\4\0", b"\6\0", b"\1\0", b"\0\1", b"\2\0", b"\3\0", b"\2\1", b"\1\1"], "?8.3")
-
-        should_same(c.read(2), b"\0\0", "?9.1")
-        #should_one_of_them(c.read(1), [b"\0", b"\1"], "?3.2")
-        rate_like, = unpack_reader("<B", c)
-        should_one_of_them(rate_like, [0, 1, 2, 3], "rate_like flag is wrong")
-        db.execute(f"UPDATE tracks SET rate_like=? WHERE id=?", [rate_like, track_id])
-        should_same(c.read(1), b"\0", "?9.3")
-
-        is_purchased_in_store, = unpack_reader("<B", c)
-        should_one_of_them(is_purchased_in_store, [0, 1, 5, 6], "is_purchased_in_store flag is wrong")
-        db.execute(f"UPDATE tracks SET is_purchased_in_store=? WHERE id=?", [is_purchased_in_store, track_id])
-        rate_star, = unpack_reader("<B", c)
-        should_one_of_them(rate_star, [0, 20, 40, 60, 80, 100], "rate_star flag is wrong")
-        db.execute(f"UPDATE tracks SET rate_star=? WHERE id=?", [rate_star, track_id])
-        should_one_of_them(c.read(1), [b"\0", b"\1", b"\2", b"\3", b"\x80", b"\x81"], "?10.3")
-        should_one_of_them(c.read(1), [b"\0", b"\1", b"\2", b"\3", b"\x80", b"\x81"], "?10.4")
-
-        should_one_of_them(c.read(1), [b"\0", b"\1", b"\2", b"\3", b"\x80", b"\x81"], "?11.1")
-        should_one_of_them(c.read(1), [b"\0", b"\1", b"\3", b"\x80", b"\x81"], "?11.2")
-        should_one_of_them(c.read(1), [b"\1", b"\2", b"\3", b"\x80", b"\x81"], "?11.3")
-        should_same(c.read(1), b"\x80", "?11.4")
-
-        should_same(c.read(4), b"\0\0\0\0", "? 12")
-        should_same(c.read(4), b"\0\0\0\0", "? 13")
-
-        should_same(c.read(2), b"\0\0", "? 14.1")
-        bpm, = c.read(1) # maybe uint16?
-        db.execute(f"UPDATE tracks SET bpm=? WHERE id=?", [bpm, track_id])
-        should_same(c.read(1), b"\0", "? 14.4")
-
-        should_one_of_them(c.read(1)[0], [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14], "?15.1")
-        should_same(c.read(3), b"\0\0\0", "? 15.2")
-
-        should_same(c.read(2), b"\0\0", "? 16.1")
-        should_one_of_them(c.read(1)[0], [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 28], "?16.3")
-        should_same(c.read(1), b"\0", "? 16.4")
-
-        # should_one_of_them(c.read(1)[0], [0, 2, 5, 10, 12, 15, 17, 22, 45, 53, 54, 76, 79, 81, 84, 86, 88, 89, 91, 93, 94, 96, 98, 99, 102, 103, 116, 122, 124, 132, 137, 153, 155, 170, 173, 181, 183, 190, 197, 198, 205, 239, 244, 247, 249, 254, 255], "?17.1")
-        c.read(1)
-        should_one_of_them(c.read(3), [b"\0\0\0", b"\xcf\xcf\xcf", b"\xff\xff\xff"], "? 17.2")
-
-        c.read(4)
-        #should_one_of_them(c.read(4), [b"\0\0\0\0", b"\x13\xdd6a", b'\r\x1c}a', b'\xba/\xae`', b'\xafy\xa3`', b'\x96\xe6wa', b'\x96\xe6wa', b'\xda\x870a', b'\xd9\x870a', b'\x1e\x90,a', b'\xfe\x1b}a', b'F\x1c}a', b'\xfd\x1b}a', b'\xb0\x15\xbd`', b'\xf5Hea'], "? 18")
-        should_same(c.read(4), b"\0\0\0\0", "? 19")
-
-        c.read(4) # ?
-
-        should_one_of_them(unpack_reader("<I", c)[0], [1, 16, 32, 0x100000], "? 21, 1 for music, 16 for pdf, 32 for music video?")
-        should_same(unpack_reader("<I", c)[0], 1, "? 22")
-        track_max, = unpack_reader("<I", c) # 23
-        db.execute(f"UPDATE tracks SET track_max=? WHERE id=?", [track_max, track_id])
-        should_same(c.read(4), b"\0\0\0\0", "? 24")
-        should_same(c.read(4), b"\0\0\0\0", "? 25")
-        should_same(c.read(4), b"\0\0\0\0", "? 26")
-        should_same(c.read(4), b"\0\0\0\0", "? 27")
-        should_same(c.read(4), b"\0\0\0\0", "? 28")
-        should_same(c.read(4), b"\0\0\0\0", "? 29")
-        should_same(c.read(4), b"\0\0\0\0", "? 30")
-        should_same(c.read(4), b"\0\0\0\0", "? 31")
-        stop_position_msec, = unpack_reader("<I", c) # 32
-        db.execute(f"UPDATE tracks SET stop_position_msec=? WHERE id=?", [stop_position_msec, track_id])
-        should_same(c.read(4), b"\0\0\0\0", "? 33")
-        track, = unpack_reader("<I", c) # 34
-        db.execute(f"UPDATE tracks SET track=? WHERE id=?", [track, track_id])
-        should_one_of_them(c.read(4), [b"\0\0\0\0", b"\0\0\1\0", b"\0\0\x10\0"], "? 35")
-        year, album_id, album_artist_or_artist_id = unpack_reader("<Iqq", c) # 36,37~38,39~40
-        if year > 0:
-            db.execute(f"UPDATE tracks SET year=? WHERE id=?", [year, track_id])
-        db.execute(f"UPDATE tracks SET album_id=? WHERE id=?", [album_id, track_id])
-        db.execute(f"UPDATE tracks SET album_artist_or_artist_id=? WHERE id=?", [album_artist_or_artist_id, track_id])
-        should_same(c.read(4), b"\0\0\0\0", "? 35")
-        should_same(c.read(4), b"\0\0\0\0", "? 36")
-        should_same(c.read(4), b"\0\0\0\0", "? 37")
-        should_same(c.read(4), b"\0\0\0\0", "? 38")
-
-        c.read(4) # ? 39
-        should_same(c.read(4), b"\0\0\0\0", "? 40")
-        c.read(8) # ? 41,42 sometimes not zero
-        c.read(8) # ? 43,44 sometimes track_id, sometimes not
-        itunes_store_matched_id, = unpack_reader("<i", c) # 45
-        # iTunes Match or Genius?
-        # sometimes wrong id is setted (e.g. remix mark as original song)
-        if itunes_store_matched_id > 0:
-            db.execute(f"UPDATE tracks SET itunes_store_matched_id=? WHERE id=?", [itunes_store_matched_id, track_id])
-        c.read(4) # 46 ?
-        c.read(4) # 47 ?
-        should_same(c.read(4), b"\0\0\0\0", "? 48")
-        c.read(4) # 49 ?
-        should_one_of_them(unpack_reader("<I", c)[0], [0, 2], "? 50, most case are 0, but sometimes 2")
-        should_one_of_them(unpack_reader("<I", c)[0], [0, 131072, 196608], "? 51, most case are 0, but sometimes 131072")
-        c.read(4) # 52 ?
-        c.read(4) # 53 ?
-        c.read(4) # 54 ?
-        c.read(4) # 55 ?
-        c.read(4) # 56 ?
-        c.read(4) # 57 ?
-        title_sort_order, album_sort_order, artist_sort_order, genre_sort_order, \
-            composer_sort_order, album_artist_sort_order, album_artist_or_artist_sort_order = unpack_reader("<iiiiiii", c) 
-        # 58, 59, 60, 61,
-        # 62, 63, 64
-        db.execute(f"UPDATE tracks SET title_sort_order=? WHERE id=?", [title_sort_order, track_id])
-        db.execute(f"UPDATE tracks SET album_sort_order=? WHERE id=?", [album_sort_order, track_id])
-        db.execute(f"UPDATE tracks SET artist_sort_order=? WHERE id=?", [artist_sort_order, track_id])
-        db.execute(f"UPDATE tracks SET genre_sort_order=? WHERE id=?", [genre_sort_order, track_id])
-        db.execute(f"UPDATE tracks SET composer_sort_order=? WHERE id=?", [composer_sort_order, track_id])
-        db.execute(f"UPDATE tracks SET album_artist_sort_order=? WHERE id=?", [album_artist_sort_order, track_id])
-        db.execute(f"UPDATE tracks SET album_artist_or_artist_sort_order=? WHERE id=?", [album_artist_or_artist_sort_order, track_id])
-        unknown_flag_65, unknown_flag_66_67 = unpack_reader("<Iq", c)
-        should_one_of_them(unknown_flag_65, [101, 17, 11, 6, 0, 12, 10], "?65: 6 in most cases, but sometimes 0")
-        # if unknown_flag_65 == 0:
-        #     should_same(unknown_flag_65, unknown_flag_66_67, "?66,67: if ?65 is 0, it should 0")
-        # else:
-        #     # chaos, idk. but it seems to related with album...?
-        #     pass
-        c.read(4)
-        #should_same(c.read(4), b"\0\0\0\0", "? 68")
-        c.read(4)
-        #should_same(c.read(4), b"\0\0\0\0", "? 69")
-        should_one_of_them(unpack_reader("<i", c)[0], [0, 3, 5, 7, 8], "? 70 most files are 3, but some files are 5 or 0")
-        should_same(c.read(4), b"\0\0\0\0", "? 71")
-        c.read(4) # ? 72, many case are 0, but some files are not 0
-        should_same(c.read(4), b"\0\0\0\0", "? 73")
-        should_same(c.read(4), b"\0\0\0\0", "? 74")
-        should_same(c.read(4), b"\0\0\0\0", "? 75")
-        should_same(c.read(4), b"\0\0\0\0", "? 76")
-        should_same(c.read(4), b"\0\0\0\0", "? 77")
-        should_same(c.read(4), b"\0\0\0\0", "? 78")
-        should_same(c.read(4), b"\0\0\0\0", "? 79")
-        should_same(c.read(4), b"\0\0\0\0", "? 80")
-        should_same(c.read(4), b"\0\0\0\0", "? 81")
-        should_same(c.read(1), b"", "end of binary")
-        # db.execute(f"UPDATE tracks SET unknown_flag=? WHERE id=?", [unpack_reader("<i", c)[0], track_id])
-
-        # db.execute(f"UPDATE tracks SET unknown_flag=? WHERE id=?", [1 if c.read(1)[0] & 1 else 0, track_id])
-        # should_one_of_them(c.read(4), [b'\x00\x01\x01\x01', b'\x00\x01\x01\x00', b'\x00\x01\x00\x01', b'\x00\x00\x00\x01', b'\x00\0\0\0'], "? 7")
+    db = connect_for_bulk_load(path)
+    tables = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    if ("tracks_normalized" in tables) != ("tracks" in storage_tables):
+        logger.warning("WARN:INCREMENTAL: existing database was created with different --intern-strings, rebuilding it")
+        db.close()
+        return None
+    if ("tracks_fts" in tables) != fts:
+        logger.warning("WARN:INCREMENTAL: existing database was created with different --fts, rebuilding it")
+        db.close()
+        return None
+    if "raw_blobs" in tables:
+        existing_raw = "dedup"
+    elif any(db.execute(f"SELECT 1 FROM {storage_table(table)} WHERE binary = X'' LIMIT 1").fetchone() for table, _, _ in ENTITY_TABLES.values()):
+        existing_raw = "none"
     else:
-        print(f"skip chunk {fourcc}...")
-with open("dump.sql", "w") as f:
-    for line in db.iterdump():
-        f.write(line)
-        f.write("\n")
-with open("unk3.json", "w") as f:
-    json.dump(unk3_dic, f, ensure_ascii=False, indent=4)
-db.commit()
-db.close()
\ No newline at end of file
+        existing_raw = "full"
+    if existing_raw != raw_mode:
+        logger.warning("WARN:INCREMENTAL: existing database was created with different --raw, rebuilding it")
+        db.close()
+        return None
+    for table, raw_table, id_column in ENTITY_TABLES.values():
+        if "hash" not in [r[1] for r in db.execute(f"PRAGMA table_info({table})")]:
+            logger.warning("WARN:INCREMENTAL: existing database has no hashes, rebuilding it")
+            db.close()
+            return None
+    # strings of unchanged entities stay in unk3_strings from the previous runs
+    create_unk3_table(db)
+    # indexes are needed for replacing raw rows of updated entities
+    create_indexes(db)
+    hashes = {}
+    for table, raw_table, id_column in ENTITY_TABLES.values():
+        hashes[table] = dict(db.execute(f"SELECT id, hash FROM {storage_table(table)}"))
+    return db, hashes
+
+INDEXES = [
+    ("tracks", "album_id"),
+    ("tracks", "album_artist_or_artist_id"),
+    ("albums_metadata_raw", "album_id"),
+    ("artists_metadata_raw", "artist_id"),
+    ("tracks_metadata_raw", "track_id"),
+]
+
+def create_indexes(db: sqlite3.Connection):
+    for table, column in INDEXES:
+        db.execute(f"CREATE INDEX IF NOT EXISTS {storage_table(table)}_{column} ON {storage_table(table)}({column})")
+
+def finish_bulk_load(db: sqlite3.Connection):
+    create_indexes(db)
+    if fts:
+        for table in FTS_COLUMNS:
+            db.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES ('optimize')")
+    violations = db.execute("PRAGMA foreign_key_check").fetchall()
+    if len(violations) > 0:
+        raise Exception(f"{len(violations)} rows have broken foreign keys (table, rowid, parent, fkid): {violations[:10]}")
+    db.execute("ANALYZE")
+    db.commit()
+
+# deletes entities which are not in the library anymore, children first
+def delete_unseen_entities(db: sqlite3.Connection):
+    for table, raw_table, id_column in reversed(ENTITY_TABLES.values()):
+        deleted = [(entity_id,) for entity_id in known_hashes[table].keys() - set(seen_ids[table])]
+        if fts:
+            delete_fts_rows(db, table, deleted)
+        db.executemany(f"DELETE FROM {storage_table(raw_table)} WHERE {id_column}=?", deleted)
+        db.executemany(f"DELETE FROM {storage_table(table)} WHERE id=?", deleted)
+        updated = len(seen_ids[table]) - unchanged_counts[table]
+        logger.info("INCREMENTAL:%s unchanged %d updated %d deleted %d", table.upper(), unchanged_counts[table], updated, len(deleted))
+    if string_ids is not None:
+        tracks_table = storage_table("tracks")
+        used_ids = " UNION ".join(f'SELECT "{column}" FROM {tracks_table}' for column in INTERNED_COLUMNS_TRACK)
+        db.execute(f"DELETE FROM strings WHERE id NOT IN ({used_ids})")
+    if blob_ids is not None:
+        used_ids = " UNION ".join(f"SELECT binary FROM {storage_table(raw_table)}" for table, raw_table, id_column in ENTITY_TABLES.values())
+        db.execute(f"DELETE FROM raw_blobs WHERE id NOT IN ({used_ids})")
+
+def exported_type(table: str, column: str, type: str):
+    if table == "tracks" and column in INTERNED_COLUMNS_TRACK:
+        return "TEXT"
+    if table.endswith("_metadata_raw") and column == "binary":
+        return "BLOB"
+    return type
+
+class RowExporter:
+    def __init__(self, db: sqlite3.Connection, directory: str, no_blobs: bool):
+        self.directory = directory
+        self.paths = []
+        # table: [(index in row, column name, column type)]
+        self.columns = {}
+        for table in pending_rows:
+            if no_blobs and table.endswith("_metadata_raw"):
+                continue
+            # interned columns are exported as strings, and deduplicated raw chunks as they are
+            info = [(r[1], exported_type(table, r[1], r[2])) for r in db.execute(f"PRAGMA table_info({storage_table(table)})")]
+            self.columns[table] = [(i, name, type) for i, (name, type) in enumerate(info) if not (no_blobs and type == "BLOB")]
+        self.files = {}
+
+    def write(self, table: str, rows: list):
+        columns = self.columns.get(table)
+        if columns is None:
+            return
+        if table not in self.files:
+            self.files[table] = self.open(table, columns)
+        self.write_rows(self.files[table], columns, rows)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+class NDJSONExporter(RowExporter):
+    def open(self, table: str, columns: list):
+        path = os.path.join(self.directory, f"{table}.ndjson")
+        self.paths.append(path)
+        return open(path, "w")
+
+    def write_rows(self, f, columns: list, rows: list):
+        for row in rows:
+            f.write(json.dumps({
+                name: b64encode(row[i]).decode() if type == "BLOB" and row[i] is not None else row[i] for i, name, type in columns
+            }, ensure_ascii=False))
+            f.write("\n")
+
+class ParquetExporter(RowExporter):
+    def __init__(self, *args):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception("--export parquet needs pyarrow, please install it with `pip3 install pyarrow`")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        super().__init__(*args)
+
+    def open(self, table: str, columns: list):
+        types = {"INTEGER": self.pa.int64(), "TEXT": self.pa.string(), "BLOB": self.pa.binary()}
+        schema = self.pa.schema([(name, types[type]) for i, name, type in columns])
+        path = os.path.join(self.directory, f"{table}.parquet")
+        self.paths.append(path)
+        return self.pq.ParquetWriter(path, schema)
+
+    def write_rows(self, writer, columns: list, rows: list):
+        writer.write_table(self.pa.Table.from_arrays(
+            [self.pa.array([row[i] for row in rows], writer.schema.field(name).type) for i, name, type in columns],
+            schema=writer.schema,
+        ))
+
+ROW_EXPORTERS = {
+    "ndjson": NDJSONExporter,
+    "parquet": ParquetExporter,
+}
+
+def export_sqlite(db: sqlite3.Connection, path: str, no_blobs: bool):
+    if os.path.exists(path):
+        os.remove(path)
+    db.execute("VACUUM INTO ?", [path])
+    if no_blobs:
+        copy = sqlite3.connect(path)
+        for table, raw_table, id_column in ENTITY_TABLES.values():
+            if storage_table(raw_table) != raw_table:
+                copy.execute(f"DROP VIEW {raw_table}")
+            copy.execute(f"DROP TABLE {storage_table(raw_table)}")
+            copy.execute(f"UPDATE {storage_table(table)} SET binary=X'', hash=X''")
+        copy.execute("DROP TABLE IF EXISTS raw_blobs")
+        copy.commit()
+        copy.execute("VACUUM")
+        copy.close()
+
+def export_sql(db: sqlite3.Connection, path: str, no_blobs: bool):
+    source = db
+    if no_blobs or fts:
+        stripped_path = path + ".sqlite3.tmp"
+        export_sqlite(db, stripped_path, no_blobs)
+        source = sqlite3.connect(stripped_path)
+        # iterdump() writes virtual tables into sqlite_master directly, which can't be loaded by default,
+        # so search indexes are rebuilt by the dump instead
+        if fts:
+            for table in FTS_COLUMNS:
+                source.execute(f"DROP TABLE {table}_fts")
+    with open(path, "w") as f:
+        for line in source.iterdump():
+            f.write(line)
+            f.write("\n")
+        if fts:
+            for table in FTS_COLUMNS:
+                f.write(f"{fts_table_sql(table)};\n")
+                f.write(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild');\n")
+    if no_blobs or fts:
+        source.close()
+        os.remove(stripped_path)
+
+def convert(args, db: sqlite3.Connection):
+    global string_ids, next_string_id, blob_ids, next_blob_id
+    table_columns.update({table: [r[1] for r in db.execute(f"PRAGMA table_info({storage_table(table)})")] for table in pending_rows})
+    if args.intern_strings:
+        string_ids = {value: string_id for string_id, value in db.execute("SELECT id, value FROM strings")}
+        next_string_id = max(string_ids.values(), default=0) + 1
+        musicdb.decoded_strings_subtypes.update(INTERNED_SUBTYPES_TRACK)
+    if raw_mode == "dedup":
+        blob_ids = dict(db.execute("SELECT hash, id FROM raw_blobs"))
+        next_blob_id = max(blob_ids.values(), default=0) + 1
+
+    for export in args.export:
+        if export in ROW_EXPORTERS:
+            row_exporters.append(ROW_EXPORTERS[export](db, args.export_dir, args.export_no_blobs))
+
+    jobs = args.jobs or os.cpu_count()
+    start = perf_counter()
+    content = get_content(args.library)
+    if jobs > 1:
+        records = parse_parallel(content, jobs, db, args.output_dir)
+    else:
+        records = parse_chunks(content, on_entity=lambda: flush_rows(db))
+    content.close()
+    phase_times["parse"] = perf_counter() - start - sum(phase_times[phase] for phase in ["read", "decrypt", "decompress", "insert", "export"])
+    phase_bytes["parse"] = phase_bytes["decompress"]
+    stage_peak_rss["parse"] = peak_rss(resource.RUSAGE_SELF)
+    logger.info("parsed %d records", records)
+    flush_rows(db, force=True)
+    if len(row_exporters) > 0:
+        with measure("export"):
+            for exporter in row_exporters:
+                exporter.close()
+    with measure("insert"):
+        if known_hashes is not None:
+            delete_unseen_entities(db)
+
+        db.execute("DROP TABLE IF EXISTS anomalies")
+        db.execute("CREATE TABLE anomalies (label TEXT PRIMARY KEY NOT NULL, count INTEGER NOT NULL, expected TEXT, actual TEXT)")
+        db.executemany("INSERT INTO anomalies (label, count, expected, actual) VALUES (?,?,?,?)", [
+            (label, count, repr(musicdb.anomaly_examples[label][0]), repr(musicdb.anomaly_examples[label][1])) for label, count in musicdb.anomaly_counts.items()
+        ])
+        finish_bulk_load(db)
+    phase_bytes["insert"] = os.path.getsize(db.execute("PRAGMA database_list").fetchone()[2])
+    stage_peak_rss["insert"] = peak_rss(resource.RUSAGE_SELF)
+
+    export_paths = [path for exporter in row_exporters for path in exporter.paths]
+    with measure("export"):
+        if "sql" in args.export:
+            export_paths.append(os.path.join(args.export_dir, "dump.sql"))
+            export_sql(db, export_paths[-1], args.export_no_blobs)
+        if "sqlite" in args.export:
+            export_paths.append(os.path.join(args.export_dir, "library.export.sqlite3"))
+            export_sqlite(db, export_paths[-1], args.export_no_blobs)
+    phase_bytes["export"] = sum(os.path.getsize(path) for path in export_paths)
+    stage_peak_rss["export"] = peak_rss(resource.RUSAGE_SELF)
+    for label, count in musicdb.anomaly_counts.most_common():
+        logger.warning("WARN:ANOMALY %d %s (expected: %r, actual: %r)", count, label, *musicdb.anomaly_examples[label])
+    if args.anomaly_report is not None:
+        with open(args.anomaly_report, "w") as f:
+            json.dump({
+                "validate": args.validate,
+                "records": records,
+                "validated_records": validated_records,
+                "anomalies": {label: {"count": count, "expected": repr(musicdb.anomaly_examples[label][0]), "actual": repr(musicdb.anomaly_examples[label][1])} for label, count in musicdb.anomaly_counts.most_common()},
+            }, f, ensure_ascii=False, indent=4)
+    if args.unk3_report is not None:
+        write_unk3_report(db, args.unk3_report)
+    if args.stats is not None:
+        write_stats(args, records, perf_counter() - start)
+    return records
+
+# {subtype: {unk3: string}}, written while reading the table instead of building the dict
+def write_unk3_report(db: sqlite3.Connection, path: str):
+    with open(path, "w") as f:
+        f.write("{")
+        last_subtype = None
+        for subtype, unk3, s in db.execute("SELECT subtype, unk3, string FROM unk3_strings ORDER BY subtype, unk3"):
+            if subtype != last_subtype:
+                f.write(f'\n    "{subtype}": {{' if last_subtype is None else f'\n    }},\n    "{subtype}": {{')
+                last_subtype = subtype
+                separator = ""
+            f.write(f'{separator}\n        "{unk3}": {json.dumps(s, ensure_ascii=False)}')
+            separator = ","
+        f.write("}\n" if last_subtype is None else "\n    }\n}\n")
+
+# ru_maxrss is in bytes on macOS and in KiB on Linux
+def peak_rss(who: int):
+    rss = resource.getrusage(who).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def write_stats(args, records: int, seconds: float):
+    phases = {}
+    for phase in ["read", "decrypt", "decompress", "parse", "insert", "export"]:
+        phases[phase] = {
+            "seconds": phase_times[phase],
+            "bytes": phase_bytes[phase],
+            "bytes_per_sec": phase_bytes[phase] / phase_times[phase] if phase_times[phase] > 0 else None,
+        }
+    bomas = {}
+    for (fourcc, subtype), count in sorted(boma_subtype_counts.items()):
+        bomas.setdefault(fourcc.decode(errors="replace"), {})[hex(subtype)] = count
+    for phase, stats in phases.items():
+        logger.info("STATS:%s %.3fs %d bytes", phase.upper(), stats["seconds"], stats["bytes"])
+    with open(args.stats, "w") as f:
+        json.dump({
+            "library": args.library,
+            "jobs": args.jobs or os.cpu_count(),
+            "seconds": seconds,
+            "records": records,
+            "phases": phases,
+            "chunks": {fourcc.decode(errors="replace"): count for fourcc, count in sorted(musicdb.chunk_counts.items())},
+            "bomas": bomas,
+            "rows": dict(row_counts),
+            "peak_rss": peak_rss(resource.RUSAGE_SELF),
+            "peak_rss_workers": peak_rss(resource.RUSAGE_CHILDREN),
+            "peak_rss_stages": stage_peak_rss,
+        }, f, indent=4)
+
+# converts args.library into args.output_dir/library.sqlite3, returns the number of records
+def convert_library(args):
+    global validate_mode, validate_every, track_unk3, known_hashes, raw_mode, raw_compress, fts
+    validate_mode = args.validate
+    validate_every = args.validate_every
+    musicdb.validating = validate_mode != "none"
+    track_unk3 = validate_mode != "none" or args.unk3_report is not None
+    musicdb.unk3_strings = [] if track_unk3 else None
+    raw_mode = args.raw
+    raw_compress = args.raw_compress
+    fts = args.fts
+
+    if args.intern_strings:
+        storage_tables["tracks"] = "tracks_normalized"
+    if raw_mode == "dedup":
+        for table, raw_table, id_column in ENTITY_TABLES.values():
+            storage_tables[raw_table] = raw_table + "_dedup"
+
+    output = os.path.join(args.output_dir, "library.sqlite3")
+    temp_output = output + ".tmp"
+    existing = None
+    if args.incremental and os.path.exists(output):
+        copyfile(output, temp_output)
+        existing = open_existing_database(temp_output)
+    if existing is not None:
+        db, known_hashes = existing
+    else:
+        db = create_database(temp_output, args.intern_strings, raw_mode)
+    try:
+        records = convert(args, db)
+        db.close()
+        os.replace(temp_output, output)
+    except BaseException:
+        db.close()
+        os.remove(temp_output)
+        raise
+    return records
+
+# batch mode: every library is converted in its own worker process (so the global state above is per library),
+# into its own directory named after the library
+def find_libraries(paths: list):
+    libraries = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                libraries.extend(os.path.join(directory, filename) for filename in sorted(filenames) if filename.endswith(".musicdb"))
+        else:
+            libraries.append(path)
+    return libraries
+
+# ".../Music Library.musiclibrary/Library.musicdb" is "Music Library", "user1.musicdb" is "user1"
+def library_name(path: str):
+    directory, filename = os.path.split(os.path.abspath(path))
+    name = os.path.splitext(filename)[0]
+    if name == "Library":
+        name = os.path.splitext(os.path.basename(directory))[0]
+    return name
+
+def convert_batch_library(task):
+    args, log_level = task
+    logging.basicConfig(level=log_level, format="%(message)s")
+    start = perf_counter()
+    created = [directory for directory in dict.fromkeys([args.output_dir, args.export_dir]) if not os.path.exists(directory)]
+    try:
+        for directory in created:
+            os.makedirs(directory)
+        records = convert_library(args)
+        error = None
+    except Exception as e:
+        logger.exception("BATCH:FAILED %s", args.library)
+        records = None
+        error = f"{type(e).__name__}: {e}"
+        # a failed library doesn't leave empty directories behind
+        for directory in reversed(created):
+            if os.path.isdir(directory) and len(os.listdir(directory)) == 0:
+                os.rmdir(directory)
+    return {
+        "library": args.library,
+        "output_dir": args.output_dir,
+        "seconds": perf_counter() - start,
+        "records": records,
+        "error": error,
+    }
+
+def convert_batch(args):
+    start = perf_counter()
+    tasks = []
+    names = Counter()
+    for library in find_libraries(args.libraries):
+        name = library_name(library)
+        names[name] += 1
+        if names[name] > 1:
+            name += f"-{names[name]}"
+        library_args = Namespace(**vars(args))
+        library_args.library = library
+        library_args.jobs = 1
+        library_args.output_dir = os.path.join(args.output_dir, name)
+        library_args.export_dir = os.path.join(args.export_dir or args.output_dir, name)
+        # per-library reports are written into the directory of the library
+        if args.stats is not None:
+            library_args.stats = os.path.join(library_args.output_dir, args.stats)
+        if args.anomaly_report is not None:
+            library_args.anomaly_report = os.path.join(library_args.output_dir, args.anomaly_report)
+        if args.unk3_report is not None:
+            library_args.unk3_report = os.path.join(library_args.output_dir, args.unk3_report)
+        tasks.append((library_args, logger.getEffectiveLevel()))
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = []
+    # a new process per library, so nothing is carried over from the previous one
+    with Pool(args.jobs or os.cpu_count(), maxtasksperchild=1) as pool:
+        for result in pool.imap(convert_batch_library, tasks):
+            if result["error"] is None:
+                logger.info("BATCH:DONE %s %.3fs %d records", result["library"], result["seconds"], result["records"])
+            results.append(result)
+    failed = [result for result in results if result["error"] is not None]
+    if args.merge is not None:
+        merge_databases(args.merge, [result for result in results if result["error"] is None])
+    with open(os.path.join(args.output_dir, "summary.json"), "w") as f:
+        json.dump({
+            "seconds": perf_counter() - start,
+            "converted": len(results) - len(failed),
+            "failed": len(failed),
+            "libraries": results,
+        }, f, ensure_ascii=False, indent=4)
+    logger.info("BATCH: converted %d, failed %d in %.3fs", len(results) - len(failed), len(failed), perf_counter() - start)
+    for result in failed:
+        logger.error("BATCH:FAILED %s %s", result["library"], result["error"])
+    return len(failed) == 0
+
+MERGED_TABLES = ["albums", "artists", "tracks", "albums_metadata_raw", "artists_metadata_raw", "tracks_metadata_raw", "anomalies", "unk3_strings"]
+MERGED_PRIMARY_KEYS = {"albums": "id", "artists": "id", "tracks": "id", "anomalies": "label", "unk3_strings": "subtype, unk3"}
+MERGED_FOREIGN_KEYS = {
+    "tracks": [("album_id", "albums"), ("album_artist_or_artist_id", "artists")],
+    "albums_metadata_raw": [("album_id", "albums")],
+    "artists_metadata_raw": [("artist_id", "artists")],
+    "tracks_metadata_raw": [("track_id", "tracks")],
+}
+
+# merges converted libraries into one database, every table gets library_id (id of the libraries table).
+# interned strings and deduplicated raw chunks are stored as they are shown by the views.
+def merge_databases(path: str, results: list):
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    db = connect_for_bulk_load(temp_path)
+    db.execute("CREATE TABLE libraries (id INTEGER PRIMARY KEY NOT NULL, library TEXT NOT NULL, output_dir TEXT NOT NULL)")
+    try:
+        for library_id, result in enumerate(results, 1):
+            db.execute("INSERT INTO libraries (id, library, output_dir) VALUES (?,?,?)", [library_id, result["library"], result["output_dir"]])
+            db.execute("ATTACH DATABASE ? AS library", [os.path.join(result["output_dir"], "library.sqlite3")])
+            for table in MERGED_TABLES:
+                columns = [(r[1], exported_type(table, r[1], r[2])) for r in db.execute(f"PRAGMA library.table_info({table})")]
+                if library_id == 1:
+                    definitions = ["library_id INTEGER NOT NULL REFERENCES libraries(id)", *(f'"{name}" {type}' for name, type in columns)]
+                    if table in MERGED_PRIMARY_KEYS:
+                        definitions.append(f"PRIMARY KEY (library_id, {MERGED_PRIMARY_KEYS[table]})")
+                    for column, parent in MERGED_FOREIGN_KEYS.get(table, []):
+                        definitions.append(f"FOREIGN KEY (library_id, {column}) REFERENCES {parent}(library_id, id)")
+                    db.execute(f"CREATE TABLE {table} ({', '.join(definitions)})")
+                column_names = ", ".join(f'"{name}"' for name, type in columns)
+                db.execute(f"INSERT INTO main.{table} (library_id, {column_names}) SELECT ?, {column_names} FROM library.{table}", [library_id])
+            db.commit()
+            db.execute("DETACH DATABASE library")
+        if len(results) > 0:
+            for table, column in INDEXES:
+                db.execute(f"CREATE INDEX {table}_{column} ON {table}(library_id, {column})")
+            if fts:
+                for table in FTS_COLUMNS:
+                    db.execute(fts_table_sql(table, "rowid"))
+                    db.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+        violations = db.execute("PRAGMA foreign_key_check").fetchall()
+        if len(violations) > 0:
+            raise Exception(f"{len(violations)} rows have broken foreign keys (table, rowid, parent, fkid): {violations[:10]}")
+        db.execute("ANALYZE")
+        db.commit()
+        db.close()
+        os.replace(temp_path, path)
+    except BaseException:
+        db.close()
+        os.remove(temp_path)
+        raise
+
+def main():
+    global fts
+    args = parser.parse_args()
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)], format="%(message)s")
+    if args.incremental and ("ndjson" in args.export or "parquet" in args.export):
+        parser.error("--export ndjson/parquet are written from decoded records, so they can't be used with --incremental")
+    if args.raw_compress and args.raw != "dedup":
+        parser.error("--raw-compress needs --raw=dedup")
+    if len(args.libraries) > 1 or os.path.isdir(args.libraries[0]):
+        # these are written per library, into the directory of each library
+        for option, path in [("--stats", args.stats), ("--anomaly-report", args.anomaly_report), ("--unk3-report", args.unk3_report)]:
+            if path is not None and os.path.isabs(path):
+                parser.error(f"{option} must be a relative path in batch mode, it's written into the directory of each library")
+        fts = args.fts
+        if not convert_batch(args):
+            sys.exit(1)
+        return
+    if args.merge is not None:
+        parser.error("--merge needs several libraries or a directory of them")
+    args.library = args.libraries[0]
+    if args.export_dir is None:
+        args.export_dir = args.output_dir
+    os.makedirs(args.output_dir, exist_ok=True)
+    os.makedirs(args.export_dir, exist_ok=True)
+    convert_library(args)
+
+if __name__ == "__main__":
+    main()
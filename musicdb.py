@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+# streaming parser of Apple's Library.musicdb, usable without SQLite:
+#
+#     for entity in iter_entities("Library.musicdb"):
+#         if isinstance(entity, Track) and entity.genre == "Anime":
+#             print(entity.title)
+from io import BufferedReader, RawIOBase
+from Crypto.Cipher import AES
+from struct import Struct, unpack, unpack_from
+import zlib
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from operator import itemgetter
+from time import perf_counter
+import plistlib
+from xml.parsers.expat import ExpatError
+
+FOURCC = b"hfma"
+AES_KEY = b"BHUILuilfghuila3"
+READ_BLOCK_SIZE = 1024 * 1024 # must be a multiple of the AES block size (16)
+CHUNK_HEADER = Struct("<4sI")
+BOMA_STRING_HEADER = Struct("<IIIII")
+UTF16_COLUMNS_ALBUM = {
+    300: "title",
+    301: "artist",
+    302: "album_artist",
+}
+UTF16_COLUMNS_ARTIST = {
+    400: "name",
+    401: "name_for_sort",
+}
+UTF16_COLUMNS_TRACK = {
+    0x2: "title",
+    0x3: "album",
+    0x4: "artist",
+    0x5: "genre",
+    0x6: "localized_file_type",
+    0x8: "comment",
+    0xb: "url",
+    0xc: "composer",
+    0x12: "description",
+    0x1B: "album_artist",
+    0x1D: "itunes_store_movi",
+    0x1E: "title_for_sort",
+    0x1F: "album_for_sort",
+    0x20: "artist_for_sort",
+    0x21: "album_artist_for_sort",
+    0x22: "composer_for_sort",
+    0x2b: "isrc",
+    0x2e: "copyright",
+    0x34: "itunes_store_flavor",
+    0x3B: "purchaser_email",
+    0x3C: "purchaser_name",
+    0x3F: "group",
+}
+
+UNKNOWN_CONST_BOMA_TRACK = {
+    # 0x38: coming from some old webview's purchase/redownload button?
+    # 0x38: b'8\x00\x00\x00\x00\x00\x00\x00<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n<plist version="1.0">\n<dict/>\n</plist>\n',
+}
+
+# fixed-layout part of the itma chunk, decoded with a single Struct.unpack_from:
+# (struct format, column name or None, expected value (should_same) or values (should_one_of_them) or None, label)
+ITMA_FIELDS = [
+    ("4x", None, None, None), # ?
+    ("I", None, None, None), # boma_counts
+    ("q", None, None, None), # id
+    ("4x", None, None, None), # ?
+    ("4s", None, [b"\0\0\0\0", b"\0\0\0\1", b"\0\1\0\1", b"\0\1\0\0", b"\0\0\1\1", b"\0\0\1\0"], "? 1"),
+    ("4s", None, [b"\0\0\0\0", b"\1\0\0\0", b"\0\1\0\0"], "? 2"),
+
+    ("2s", None, b"\0\0", "?3.1"),
+    ("B", "album_is_compilation", [0, 1], "album_is_complation flag is wrong"),
+    ("c", None, [b"\0", b"\1"], "?3.2"),
+
+    ("4s", None, [b"\0\0\0\0", b"\0\0\1\0"], "? 4"),
+
+    ("3s", None, b"\0\0\0", "? 5.1"),
+    ("B", None, [0, 1], "? 5.2 unknown flag, zero in 99% cases, but only some rare cases, this will be 1"),
+
+    ("c", None, b"\0", "?6.1"),
+    ("B", None, [0, 1], "? 6.2 unknown flag, zero in 99% cases, but only some rare cases, this will be 1"),
+    ("2s", None, [b"\0\0", b"\1\0", b"\0\1"], "?6.3"),
+
+    ("c", None, [b"\0", b"\1"], "?7.1"),
+    ("B", None, [0, 1], "? 7.2 unknown flag, sometimes 1."),
+    ("B", None, [0, 1], "? 7.3 unknown flag, sometimes 1."),
+    ("B", None, [0, 1], "? 7.4 unknown flag, sometimes 1."),
+
+    ("c", None, b"\0", "?8.1"),
+    ("B", None, [0, 1, 3], "? 8.2 unknown flag, sometimes 1."),
+    ("2s", None, [b"\0\0", b"\4\0", b"\6\0", b"\1\0", b"\0\1", b"\2\0", b"\3\0", b"\2\1", b"\1\1"], "?8.3"),
+
+    ("2s", None, b"\0\0", "?9.1"),
+    ("B", "rate_like", [0, 1, 2, 3], "rate_like flag is wrong"),
+    ("c", None, b"\0", "?9.3"),
+
+    ("B", "is_purchased_in_store", [0, 1, 5, 6], "is_purchased_in_store flag is wrong"),
+    ("B", "rate_star", [0, 20, 40, 60, 80, 100], "rate_star flag is wrong"),
+    ("c", None, [b"\0", b"\1", b"\2", b"\3", b"\x80", b"\x81"], "?10.3"),
+    ("c", None, [b"\0", b"\1", b"\2", b"\3", b"\x80", b"\x81"], "?10.4"),
+
+    ("c", None, [b"\0", b"\1", b"\2", b"\3", b"\x80", b"\x81"], "?11.1"),
+    ("c", None, [b"\0", b"\1", b"\3", b"\x80", b"\x81"], "?11.2"),
+    ("c", None, [b"\1", b"\2", b"\3", b"\x80", b"\x81"], "?11.3"),
+    ("c", None, b"\x80", "?11.4"),
+
+    ("4s", None, b"\0\0\0\0", "? 12"),
+    ("4s", None, b"\0\0\0\0", "? 13"),
+
+    ("2s", None, b"\0\0", "? 14.1"),
+    ("B", "bpm", None, None), # maybe uint16?
+    ("c", None, b"\0", "? 14.4"),
+
+    ("B", None, [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14], "?15.1"),
+    ("3s", None, b"\0\0\0", "? 15.2"),
+
+    ("2s", None, b"\0\0", "? 16.1"),
+    ("B", None, [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 28], "?16.3"),
+    ("c", None, b"\0", "? 16.4"),
+
+    # ("B", None, [0, 2, 5, 10, 12, 15, 17, 22, 45, 53, 54, 76, 79, 81, 84, 86, 88, 89, 91, 93, 94, 96, 98, 99, 102, 103, 116, 122, 124, 132, 137, 153, 155, 170, 173, 181, 183, 190, 197, 198, 205, 239, 244, 247, 249, 254, 255], "?17.1"),
+    ("x", None, None, None),
+    ("3s", None, [b"\0\0\0", b"\xcf\xcf\xcf", b"\xff\xff\xff"], "? 17.2"),
+
+    # ("4s", None, [b"\0\0\0\0", b"\x13\xdd6a", b'\r\x1c}a', b'\xba/\xae`', b'\xafy\xa3`', b'\x96\xe6wa', b'\x96\xe6wa', b'\xda\x870a', b'\xd9\x870a', b'\x1e\x90,a', b'\xfe\x1b}a', b'F\x1c}a', b'\xfd\x1b}a', b'\xb0\x15\xbd`', b'\xf5Hea'], "? 18"),
+    ("4x", None, None, None),
+    ("4s", None, b"\0\0\0\0", "? 19"),
+
+    ("4x", None, None, None), # ?
+
+    ("I", None, [1, 16, 32, 0x100000], "? 21, 1 for music, 16 for pdf, 32 for music video?"),
+    ("I", None, 1, "? 22"),
+    ("I", "track_max", None, None), # 23
+    ("4s", None, b"\0\0\0\0", "? 24"),
+    ("4s", None, b"\0\0\0\0", "? 25"),
+    ("4s", None, b"\0\0\0\0", "? 26"),
+    ("4s", None, b"\0\0\0\0", "? 27"),
+    ("4s", None, b"\0\0\0\0", "? 28"),
+    ("4s", None, b"\0\0\0\0", "? 29"),
+    ("4s", None, b"\0\0\0\0", "? 30"),
+    ("4s", None, b"\0\0\0\0", "? 31"),
+    ("I", "stop_position_msec", None, None), # 32
+    ("4s", None, b"\0\0\0\0", "? 33"),
+    ("I", "track", None, None), # 34
+    ("4s", None, [b"\0\0\0\0", b"\0\0\1\0", b"\0\0\x10\0"], "? 35"),
+    ("I", "year", None, None), # 36, 0 if not set
+    ("q", "album_id", None, None), # 37~38
+    ("q", "album_artist_or_artist_id", None, None), # 39~40
+    ("4s", None, b"\0\0\0\0", "? 35"),
+    ("4s", None, b"\0\0\0\0", "? 36"),
+    ("4s", None, b"\0\0\0\0", "? 37"),
+    ("4s", None, b"\0\0\0\0", "? 38"),
+
+    ("4x", None, None, None), # ? 39
+    ("4s", None, b"\0\0\0\0", "? 40"),
+    ("8x", None, None, None), # ? 41,42 sometimes not zero
+    ("8x", None, None, None), # ? 43,44 sometimes track_id, sometimes not
+    # iTunes Match or Genius?
+    # sometimes wrong id is setted (e.g. remix mark as original song)
+    ("i", "itunes_store_matched_id", None, None), # 45, 0 or negative if not set
+    ("4x", None, None, None), # 46 ?
+    ("4x", None, None, None), # 47 ?
+    ("4s", None, b"\0\0\0\0", "? 48"),
+    ("4x", None, None, None), # 49 ?
+    ("I", None, [0, 2], "? 50, most case are 0, but sometimes 2"),
+    ("I", None, [0, 131072, 196608], "? 51, most case are 0, but sometimes 131072"),
+    ("24x", None, None, None), # 52~57 ?
+    ("i", "title_sort_order", None, None), # 58
+    ("i", "album_sort_order", None, None), # 59
+    ("i", "artist_sort_order", None, None), # 60
+    ("i", "genre_sort_order", None, None), # 61
+    ("i", "composer_sort_order", None, None), # 62
+    ("i", "album_artist_sort_order", None, None), # 63
+    ("i", "album_artist_or_artist_sort_order", None, None), # 64
+    ("I", None, [101, 17, 11, 6, 0, 12, 10], "?65: 6 in most cases, but sometimes 0"),
+    # if ?65 is 0, ?66,67 should be 0? otherwise chaos, idk. but it seems to related with album...?
+    ("8x", None, None, None), # 66,67
+    ("4x", None, None, None), # ("4s", None, b"\0\0\0\0", "? 68"),
+    ("4x", None, None, None), # ("4s", None, b"\0\0\0\0", "? 69"),
+    ("i", None, [0, 3, 5, 7, 8], "? 70 most files are 3, but some files are 5 or 0"),
+    ("4s", None, b"\0\0\0\0", "? 71"),
+    ("4x", None, None, None), # ? 72, many case are 0, but some files are not 0
+    ("4s", None, b"\0\0\0\0", "? 73"),
+    ("4s", None, b"\0\0\0\0", "? 74"),
+    ("4s", None, b"\0\0\0\0", "? 75"),
+    ("4s", None, b"\0\0\0\0", "? 76"),
+    ("4s", None, b"\0\0\0\0", "? 77"),
+    ("4s", None, b"\0\0\0\0", "? 78"),
+    ("4s", None, b"\0\0\0\0", "? 79"),
+    ("4s", None, b"\0\0\0\0", "? 80"),
+    ("4s", None, b"\0\0\0\0", "? 81"),
+]
+ITMA_STRUCT = Struct("<" + "".join(field[0] for field in ITMA_FIELDS))
+_ITMA_VALUE_FIELDS = [field for field in ITMA_FIELDS if not field[0].endswith("x")]
+ITMA_COLUMNS = [(i, field[1]) for i, field in enumerate(_ITMA_VALUE_FIELDS) if field[1] is not None]
+ITMA_CHECKS = [(i, field[2], field[3]) for i, field in enumerate(_ITMA_VALUE_FIELDS) if field[2] is not None]
+# split once: equality checks are compared all at once (and one by one only on a mismatch),
+# one-of checks are set lookups (the list is kept for the anomaly example)
+ITMA_SAME_CHECKS = [(i, expected, label) for i, expected, label in ITMA_CHECKS if not isinstance(expected, list)]
+ITMA_SAME_VALUES = itemgetter(*[i for i, expected, label in ITMA_SAME_CHECKS])
+ITMA_SAME_EXPECTED = tuple(expected for i, expected, label in ITMA_SAME_CHECKS)
+ITMA_ONE_OF_CHECKS = [(i, frozenset(expected), expected, label) for i, expected, label in ITMA_CHECKS if isinstance(expected, list)]
+ENTITY_HEADER = Struct("<Iq") # boma count and id, at offset 4 of every entity chunk
+
+
+logger = logging.getLogger("musicdb")
+
+# seconds and bytes of the read/decrypt/decompress phases, and count of chunks per fourcc
+phase_times = Counter()
+phase_bytes = Counter()
+chunk_counts = Counter()
+
+@contextmanager
+def measure(phase: str):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        phase_times[phase] += perf_counter() - start
+
+# while validating, unexpected values are counted per check label instead of aborting,
+# so new iTunes/Music versions can still be converted while we collect the format drift
+anomaly_counts = Counter()
+anomaly_examples = {}
+validating = False
+
+def report_anomaly(message: str, expected, actual):
+    anomaly_counts[message] += 1
+    if message not in anomaly_examples:
+        anomaly_examples[message] = (expected, actual)
+
+def should_same(actual, expected, message: str, skip=False):
+    if actual != expected and not skip and validating:
+        report_anomaly(message, expected, actual)
+def should_one_of_them(actual, expected_patterns: list, message: str, skip=False):
+    if skip or not validating:
+        return
+    for expected in expected_patterns:
+        if actual == expected:
+            return
+    report_anomaly(message, expected_patterns, actual)
+
+# for structural checks, we can't continue parsing if these are wrong
+def must_same(actual, expected, message: str):
+    if actual != expected:
+        raise Exception(f"{message} (expected: {expected}, actual: {actual})")
+
+# decrypts the encrypted prefix and inflates the payload on the fly,
+# so only READ_BLOCK_SIZE bytes of input (and one read() of output) are held in memory at once
+class DecryptingDecompressor(RawIOBase):
+    def __init__(self, f, encrypted_size: int):
+        self.f = f
+        self.encrypted_remaining = encrypted_size
+        self.cipher = AES.new(AES_KEY, AES.MODE_ECB)
+        self.decompressor = zlib.decompressobj()
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+        super().close()
+
+    def _next_input(self):
+        with measure("read"):
+            data = self.f.read(min(READ_BLOCK_SIZE, self.encrypted_remaining) if self.encrypted_remaining > 0 else READ_BLOCK_SIZE)
+        phase_bytes["read"] += len(data)
+        if self.encrypted_remaining > 0:
+            self.encrypted_remaining -= len(data)
+            if len(data) % 16 != 0:
+                raise Exception(f"encrypted part is truncated (size: {len(data)})")
+            with measure("decrypt"):
+                data = self.cipher.decrypt(data)
+            phase_bytes["decrypt"] += len(data)
+        return data
+
+    def readinto(self, b):
+        size = len(b)
+        while not self.pending:
+            if self.decompressor.eof:
+                return 0
+            data = self.decompressor.unconsumed_tail or self._next_input()
+            with measure("decompress"):
+                if data:
+                    self.pending = self.decompressor.decompress(data, size)
+                else:
+                    self.pending = self.decompressor.flush()
+            if not self.pending and not data:
+                raise Exception("compressed data is truncated")
+            phase_bytes["decompress"] += len(self.pending)
+        n = min(size, len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+def get_content(path: str):
+    lf = open(path, "rb")
+    first_fourcc = lf.read(4)
+    must_same(first_fourcc, FOURCC, "FourCC is wrong")
+    header_size, = unpack("<I", lf.read(4))
+    header_size -= 8 # fourcc + int32 = 8 bytes
+    header = lf.read(header_size)
+
+    file_size, = unpack("<I", header[0:4])
+    encrypted_size, = unpack("<I", header[76:80])
+    logger.info("file size: %d, encrypted size: %d", file_size, encrypted_size)
+
+    data_size = file_size - (header_size + 8)
+    encrypted_size = data_size - (data_size % 16) if encrypted_size > file_size else encrypted_size
+
+    lf.seek(header_size + 8)
+    return BufferedReader(DecryptingDecompressor(lf, encrypted_size), READ_BLOCK_SIZE)
+
+def read_chunk(content):
+    prefix = 8
+    head = content.read(8)
+    if head == b"":
+        return None
+    fourcc, chunk_len = CHUNK_HEADER.unpack(head)
+    if fourcc == b"boma":
+        prefix += 4
+        must_same(chunk_len, 20, "boma chunk first four bytes are wrong")
+        chunk_len, = unpack("<I", content.read(4))
+    c = content.read(chunk_len - prefix)
+    # print(fourcc, chunk_len, c)
+    return fourcc, c
+
+# (subtype, unk3, string, validating) of strings with non-zero unk3, collected for checking that the same unk3 always has the same string.
+# the caller takes them out in batches (see unk3_strings table of main.py), None to skip it
+unk3_strings = None
+# strings of these subtypes are decoded once per run (for strings repeated in many tracks, e.g. artist)
+decoded_strings = {}
+decoded_strings_subtypes = set()
+
+def read_utf16_boma(b: memoryview, subtype: int, errors="strict"):
+    unk1, encoding, slen, unk3, unk4 = BOMA_STRING_HEADER.unpack_from(b, 4)
+    should_same(unk1, 0, "unk1")
+    should_one_of_them(encoding, [1, 2], "unk2")
+    should_same(unk4, 0, "unk4")
+    if subtype in decoded_strings_subtypes:
+        raw = (encoding, bytes(b[24:24 + slen]))
+        s = decoded_strings.get(raw)
+        if s is None:
+            s = decoded_strings[raw] = str(raw[1], "utf-16" if encoding == 1 else "utf-8", errors)
+    else:
+        s = str(b[24:24 + slen], "utf-16" if encoding == 1 else "utf-8", errors) # maybe ASCII?
+    if unk3 != 0 and unk3_strings is not None:
+        unk3_strings.append((subtype, unk3, s, validating))
+    return s
+
+# for guessing whether an unknown boma is string or not
+def is_string_boma(b: memoryview):
+    if len(b) < 4 + BOMA_STRING_HEADER.size:
+        return False
+    unk1, encoding, slen, unk3, unk4 = BOMA_STRING_HEADER.unpack_from(b, 4)
+    return unk1 == 0 and (encoding == 1 or encoding == 2) and unk4 == 0 and 24 + slen <= len(b)
+
+# the plist after the subtype and 4 zero bytes, as bytes if it isn't a (valid) plist
+def read_plist_boma(b: memoryview, subtype: int):
+    data = bytes(b[8:])
+    if not data.startswith((b"<?xml", b"bplist")):
+        return data
+    try:
+        return plistlib.loads(data)
+    except (plistlib.InvalidFileException, ValueError, ExpatError):
+        return data
+
+def const_boma(expected: bytes):
+    def read_const_boma(b: memoryview, subtype: int):
+        should_same(bytes(b), expected, f"boma chunk that considered as const, but it looks not!? please report! (subtype={subtype})")
+    return read_const_boma
+
+def read_boma(content):
+    fcc, cbc = read_chunk(content)
+    must_same(fcc, b"boma", "not boma")
+    cc = memoryview(cbc)
+    subtype, = unpack_from("<I", cc)
+    return subtype, cbc, cc
+
+# decoded entities. fields which are not in the library are None.
+# with raw=True, `binary` is the entity chunk and `bomas` is a list of (subtype, boma chunk), otherwise both are None.
+class Entity:
+    __slots__ = ("id", "binary", "bomas")
+    FIELDS = []
+
+    def __init__(self, id: int):
+        self.id = id
+        self.binary = None
+        self.bomas = None
+        for name in self.FIELDS:
+            setattr(self, name, None)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.FIELDS if getattr(self, name) is not None)
+        return f"{type(self).__name__}(id={self.id}, {fields})"
+
+class Album(Entity):
+    FIELDS = list(UTF16_COLUMNS_ALBUM.values())
+    __slots__ = FIELDS
+
+class Artist(Entity):
+    FIELDS = list(UTF16_COLUMNS_ARTIST.values())
+    __slots__ = FIELDS
+
+class Track(Entity):
+    FIELDS = [column for i, column in ITMA_COLUMNS] + list(UTF16_COLUMNS_TRACK.values())
+    __slots__ = FIELDS
+
+# bomas which are decoded but not stored into the record: checks (like const_boma) run for every boma,
+# and the values of LOG_ONLY bomas are only decoded for logging with -vv
+CHECK = None
+LOG_ONLY = ""
+
+# fourcc: {subtype: (column name or CHECK or LOG_ONLY, decoder(memoryview of boma chunk, subtype))}
+# for decoding a new kind of boma into a column, add the column to the record class and the decoder here.
+BOMA_DECODERS = {
+    b"iama": {subtype: (column, read_utf16_boma) for subtype, column in UTF16_COLUMNS_ALBUM.items()},
+    b"iAma": {subtype: (column, read_utf16_boma) for subtype, column in UTF16_COLUMNS_ARTIST.items()},
+    b"itma": {
+        **{subtype: (column, read_utf16_boma) for subtype, column in UTF16_COLUMNS_TRACK.items()},
+        **{subtype: (CHECK, const_boma(expected)) for subtype, expected in UNKNOWN_CONST_BOMA_TRACK.items()},
+        0x38: (LOG_ONLY, read_plist_boma),
+    },
+}
+
+def parse_bomas(entity: Entity, decoders: dict, bomas: list):
+    for subtype, cbc, cc in bomas:
+        decoder = decoders.get(subtype)
+        if decoder is None:
+            # unknown strings are still decoded for the unk3 check
+            if is_string_boma(cc):
+                value = read_utf16_boma(cc, subtype, "replace")
+                logger.debug("WARN:%s:UNHANDLED_BOMA %d %s %s", type(entity).__name__.upper(), subtype, hex(subtype), value)
+            else:
+                logger.debug("WARN:%s:UNHANDLED_BOMA_BINARY %d %s %r", type(entity).__name__.upper(), subtype, hex(subtype), cbc)
+            continue
+        column_name, decode = decoder
+        if column_name is CHECK:
+            decode(cc, subtype)
+        elif column_name == LOG_ONLY:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s:BOMA %d %s %r", type(entity).__name__.upper(), subtype, hex(subtype), decode(cc, subtype))
+        else:
+            value = decode(cc, subtype)
+            if column_name == "title":
+                logger.debug("%s:TITLE %s", type(entity).__name__.upper(), value)
+            setattr(entity, column_name, value)
+
+def parse_album(album: Album, bc: bytes, bomas: list):
+    parse_bomas(album, BOMA_DECODERS[b"iama"], bomas)
+
+def parse_artist(artist: Artist, bc: bytes, bomas: list):
+    parse_bomas(artist, BOMA_DECODERS[b"iAma"], bomas)
+
+def parse_track(track: Track, bc: bytes, bomas: list):
+    # a longer chunk (e.g. from a newer version) is decoded up to the known layout
+    if len(bc) < ITMA_STRUCT.size:
+        raise Exception(f"end of binary (expected: {ITMA_STRUCT.size}, actual: {len(bc)})")
+    should_same(len(bc), ITMA_STRUCT.size, "end of binary")
+    values = ITMA_STRUCT.unpack_from(bc)
+    if validating:
+        if ITMA_SAME_VALUES(values) != ITMA_SAME_EXPECTED:
+            for i, expected, label in ITMA_SAME_CHECKS:
+                should_same(values[i], expected, label)
+        for i, allowed, expected, label in ITMA_ONE_OF_CHECKS:
+            if values[i] not in allowed:
+                report_anomaly(label, expected, values[i])
+    for i, column in ITMA_COLUMNS:
+        setattr(track, column, values[i])
+    if track.year == 0:
+        track.year = None
+    if track.itunes_store_matched_id <= 0:
+        track.itunes_store_matched_id = None
+    parse_bomas(track, BOMA_DECODERS[b"itma"], bomas)
+    # track.unknown_flag = ...
+
+# fourcc: (record class, parser)
+ENTITY_PARSERS = {
+    b"iama": (Album, parse_album),
+    b"iAma": (Artist, parse_artist),
+    b"itma": (Track, parse_track),
+}
+
+# yields (fourcc, id, entity chunk, [(subtype, boma chunk, memoryview of it)]) of every album/artist/track
+# in content (until `end` if given), without decoding them. other chunks are skipped.
+def iter_raw_entities(content, end=None):
+    while end is None or content.tell() < end:
+        r = read_chunk(content)
+        if r is None:
+            break
+        fourcc, bc = r
+        chunk_counts[fourcc] += 1
+        if fourcc in ENTITY_PARSERS:
+            boma_counts, entity_id = ENTITY_HEADER.unpack_from(bc, 4)
+            yield fourcc, entity_id, bc, [read_boma(content) for i in range(boma_counts)]
+        else:
+            logger.debug("skip chunk %r...", fourcc)
+
+def decode_entity(fourcc: bytes, entity_id: int, bc: bytes, bomas: list, raw=False):
+    entity_class, parse_entity = ENTITY_PARSERS[fourcc]
+    entity = entity_class(entity_id)
+    parse_entity(entity, bc, bomas)
+    if raw:
+        entity.binary = bc
+        entity.bomas = [(subtype, cbc) for subtype, cbc, cc in bomas]
+    return entity
+
+# yields Album, Artist and Track records one by one, only one entity is held in memory at once
+def iter_entities(path: str, raw=False):
+    with get_content(path) as content:
+        for fourcc, entity_id, bc, bomas in iter_raw_entities(content):
+            yield decode_entity(fourcc, entity_id, bc, bomas, raw)